@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for git-branchstack.  Prints results as JSON.
+
+    python3 bench.py [merge] [stack] [startup] [--topics N] [--commits N] ...
+
+The "stack" benchmark creates a synthetic repository with the given number
+of topics and commits per topic, and times each phase of create_branches.
+Commits of a topic normally change files in the topic's own directory.
+A fraction of them, given by --conflict-density, change a file shared by
+all topics instead, which forces a file-level merge when rebasing them.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import redirect_stdout
+
+from gitrevise import merge
+from gitrevise.odb import Repository
+
+import gitbranchstack.main as gitbranchstack
+
+# Benchmarks run in throwaway repositories, which need not inherit an identity.
+for variable in ("GIT_AUTHOR", "GIT_COMMITTER"):
+    os.environ.setdefault(f"{variable}_NAME", "Bench")
+    os.environ.setdefault(f"{variable}_EMAIL", "bench@example.com")
+
+SHAPES = ("independent", "chain", "star")
+SHARED_LINE_SPACING = 4
+# Time in seconds that invocations which do no real work may take, on
+# top of interpreter startup.
+STARTUP_BUDGET = 0.25
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start, result)
+
+def merge_inputs(files, lines, seed=0):
+    """
+    Returns (current, base, other) triples where each side changes a
+    different part of the file, so that all merges are clean.
+    """
+    rng = random.Random(seed)
+    inputs = []
+    for _ in range(files):
+        base = [b"line %d %d\n" % (i, rng.randrange(1 << 30)) for i in range(lines)]
+        current = list(base)
+        other = list(base)
+        current[rng.randrange(lines // 2 - 1)] = b"current\n"
+        other[lines // 2 + rng.randrange(lines // 2)] = b"other\n"
+        inputs.append((b"".join(current), b"".join(base), b"".join(other)))
+    return inputs
+
+def bench_merge(files, lines):
+    inputs = merge_inputs(files, lines)
+    with tempfile.TemporaryDirectory() as workdir:
+        subprocess.run(("git", "init", "-q", workdir), check=True)
+        with Repository(workdir) as repo:
+            tmpdir = repo.get_tempdir()
+            labels = ("current", "base", "other")
+
+            def git_merge_file():
+                return [
+                    merge.merge_files(repo, labels, current, base, other, tmpdir)[1]
+                    for current, base, other in inputs
+                ]
+
+            def in_process():
+                return [gitbranchstack.merge_lines(*triple) for triple in inputs]
+
+            (git_seconds, git_results) = timed(git_merge_file)
+            (python_seconds, python_results) = timed(in_process)
+    assert python_results == git_results
+    return {
+        "files": files,
+        "lines": lines,
+        "git_merge_file_seconds": git_seconds,
+        "merge_lines_seconds": python_seconds,
+    }
+
+def topic_parents(shape, topic):
+    if topic == 0 or shape == "independent":
+        return []
+    if shape == "chain":
+        return [topic - 1]
+    return [0]
+
+def fast_import_stream(topics, commits, shape, files, conflict_density, seed):
+    """
+    Returns input for git-fast-import that creates a base commit followed
+    by commits of all topics, interleaved.  Each commit replaces one line
+    of one file.  Lines changed in the shared file are a few lines apart,
+    so all merges are clean.
+    """
+    rng = random.Random(seed)
+    contents = {}
+    for topic in range(topics):
+        for i in range(files):
+            contents[f"t{topic}/f{i}"] = [b"%d\n" % line for line in range(commits)]
+    contents["shared"] = [
+        b"%d\n" % line for line in range(topics * commits * SHARED_LINE_SPACING)
+    ]
+
+    stream = []
+    mark = 0
+    def commit(message, paths):
+        nonlocal mark
+        mark += 1
+        stream.append(b"commit refs/heads/main\nmark :%d\n" % mark)
+        stream.append(b"committer Bench <bench@example.com> %d +0000\n" % (mark * 60))
+        message = message.encode()
+        stream.append(b"data %d\n%s\n" % (len(message), message))
+        if mark > 1:
+            stream.append(b"from :%d\n" % (mark - 1))
+        for path in paths:
+            data = b"".join(contents[path])
+            stream.append(b"M 100644 inline %s\ndata %d\n%s\n" % (path.encode(), len(data), data))
+
+    commit("base", list(contents))
+    for i in range(commits):
+        for topic in range(topics):
+            if rng.random() < conflict_density:
+                path = "shared"
+                line = (i * topics + topic) * SHARED_LINE_SPACING
+            else:
+                path = f"t{topic}/f{rng.randrange(files)}"
+                line = i
+            contents[path][line] = b"topic %d commit %d\n" % (topic, i)
+            tag = ":".join(f"t{t}" for t in [topic] + topic_parents(shape, topic))
+            commit(f"[{tag}] commit {i}", [path])
+    return b"".join(stream)
+
+def create_stack(workdir, *args):
+    """
+    Creates a synthetic repository, see fast_import_stream().
+    """
+    subprocess.run(("git", "init", "-q", workdir), check=True)
+    subprocess.run(
+        ("git", "fast-import", "--quiet"),
+        input=fast_import_stream(*args),
+        cwd=workdir,
+        check=True,
+    )
+    subprocess.run(("git", "checkout", "-q", "main"), cwd=workdir, check=True)
+
+def bench_stack(topics, commits, shape, files, conflict_density, seed):
+    with tempfile.TemporaryDirectory() as workdir:
+        create_stack(workdir, topics, commits, shape, files, conflict_density, seed)
+        with Repository(workdir) as repo:
+            gitbranchstack.INTERACTIVE = False
+            merge.conflict_prompt = gitbranchstack.non_interactive_conflict_prompt
+            gitbranchstack.REBASE_STATS.update(spliced=0, merged=0)
+            prefix_prefix, prefix_suffix = gitbranchstack.read_affixes(repo)
+            base_commit_id = repo.git("rev-parse", ":/^base").decode()
+            revision_range = f"{base_commit_id}..HEAD"
+
+            (parse_seconds, (commit_entries, dependency_graph)) = timed(
+                gitbranchstack.parse_log,
+                repo,
+                prefix_prefix,
+                prefix_suffix,
+                revision_range,
+                "--reverse",
+            )
+
+            def order_topics():
+                commits_by_topic = gitbranchstack.group_by_topic(commit_entries)
+                gitbranchstack.topological_order(dependency_graph)
+                closures = gitbranchstack.dependency_closures(dependency_graph)
+                return commits_by_topic, closures
+
+            (order_seconds, (commits_by_topic, closures)) = timed(order_topics)
+
+            path_index = gitbranchstack.PathIndex(
+                repo, prefix_prefix, prefix_suffix, revision_range
+            )
+            (prefetch_seconds, _) = timed(
+                gitbranchstack.prefetch_topics,
+                repo,
+                base_commit_id,
+                commits_by_topic,
+                closures,
+                list(commits_by_topic),
+            )
+            rebase_memo = {}
+            rebase_cache = OrderedDict()
+            build_seconds = {}
+            heads = {}
+            for topic in commits_by_topic:
+                (build_seconds[topic], heads[topic]) = timed(
+                    gitbranchstack.build_topic,
+                    repo,
+                    prefix_prefix,
+                    prefix_suffix,
+                    None,
+                    base_commit_id,
+                    commits_by_topic,
+                    closures,
+                    topic,
+                    rebase_memo,
+                    rebase_cache,
+                    path_index,
+                )
+
+            def update_refs():
+                existing_branches = gitbranchstack.read_branches(repo, heads)
+                with redirect_stdout(io.StringIO()):
+                    return gitbranchstack.update_branches(
+                        repo, existing_branches, heads
+                    )
+
+            (update_seconds, _) = timed(update_refs)
+    return {
+        "topics": topics,
+        "commits_per_topic": commits,
+        "shape": shape,
+        "files_per_topic": files,
+        "conflict_density": conflict_density,
+        "seed": seed,
+        "parse_log_seconds": parse_seconds,
+        "order_topics_seconds": order_seconds,
+        "prefetch_seconds": prefetch_seconds,
+        "build_topic_seconds": build_seconds,
+        "build_seconds": sum(build_seconds.values()),
+        "update_branches_seconds": update_seconds,
+        "rebase": dict(gitbranchstack.REBASE_STATS),
+    }
+
+def median_runtime(cmd, runs, **kwargs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+def bench_startup(runs, budget):
+    """
+    Times invocations that should not do any real work, as done by editor
+    integrations: importing the module, rejecting an invalid range, and
+    a run where all branches are up to date.  Interpreter startup is
+    subtracted, since we cannot do anything about it.
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    command = (sys.executable, "-m", "gitbranchstack.main")
+    interpreter = median_runtime((sys.executable, "-c", "pass"), runs, env=env)
+    results = {
+        "runs": runs,
+        "interpreter_seconds": interpreter,
+        "import_seconds": median_runtime(
+            (sys.executable, "-c", "import gitbranchstack.main"), runs, env=env
+        )
+        - interpreter,
+        "invalid_range_seconds": median_runtime(
+            command + ("--range", "invalid"), runs, env=env
+        )
+        - interpreter,
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        create_stack(workdir, 20, 10, "chain", 5, 0.1, 0)
+        up_to_date = command + ("--range", ":/^base..HEAD")
+        subprocess.run(up_to_date, cwd=workdir, env=env, check=True, capture_output=True)
+        results["up_to_date_seconds"] = (
+            median_runtime(up_to_date, runs, cwd=workdir, env=env) - interpreter
+        )
+    results["budget_seconds"] = budget
+    results["over_budget"] = [
+        key
+        for key in ("import_seconds", "invalid_range_seconds", "up_to_date_seconds")
+        if results[key] > budget
+    ]
+    return results
+
+def parser():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument(
+        "benchmarks",
+        nargs="*",
+        choices=("merge", "stack", "startup"),
+        help="benchmarks to run (default: all)",
+    )
+    p.add_argument(
+        "--merge-files", type=int, default=200, help="number of files to merge"
+    )
+    p.add_argument(
+        "--merge-lines", type=int, default=1000, help="number of lines per file"
+    )
+    p.add_argument("--topics", type=int, default=20, help="number of topics")
+    p.add_argument(
+        "--commits", type=int, default=10, help="number of commits per topic"
+    )
+    p.add_argument(
+        "--shape",
+        choices=SHAPES,
+        default="chain",
+        help="dependencies between topics: none, each on the previous one, or all on the first one",
+    )
+    p.add_argument("--files", type=int, default=5, help="number of files per topic")
+    p.add_argument(
+        "--conflict-density",
+        type=float,
+        default=0.1,
+        help="fraction of commits that change the file shared by all topics",
+    )
+    p.add_argument("--seed", type=int, default=0, help="seed for random choices")
+    p.add_argument(
+        "--startup-runs", type=int, default=10, help="number of runs to time startup"
+    )
+    p.add_argument(
+        "--startup-budget",
+        type=float,
+        default=STARTUP_BUDGET,
+        help="fail if a startup benchmark takes more than this many seconds",
+    )
+    return p
+
+def main(argv):
+    args = parser().parse_args(argv)
+    benchmarks = args.benchmarks or ("merge", "stack", "startup")
+    results = {}
+    if "merge" in benchmarks:
+        results["merge"] = bench_merge(args.merge_files, args.merge_lines)
+    if "stack" in benchmarks:
+        results["stack"] = bench_stack(
+            args.topics,
+            args.commits,
+            args.shape,
+            args.files,
+            args.conflict_density,
+            args.seed,
+        )
+    if "startup" in benchmarks:
+        results["startup"] = bench_startup(args.startup_runs, args.startup_budget)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    if results.get("startup", {}).get("over_budget"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,21 +1,42 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import json
 import os
+import struct
 import sys
-from typing import Dict, Optional, List, Set, Tuple
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, redirect_stdout
+from itertools import islice
+from typing import Dict, Iterator, Optional, List, Set, Tuple
 from pathlib import Path
-from subprocess import CalledProcessError
+from subprocess import CalledProcessError, PIPE, Popen
 
-import gitrevise
 from gitrevise import merge, utils
 from gitrevise.utils import EditorError
-from gitrevise.odb import Blob, Repository
+from gitrevise.odb import (
+    Blob,
+    Commit,
+    Entry,
+    GitObj,
+    Mode,
+    MissingObject,
+    Oid,
+    Repository,
+    Tree,
+)
 from gitrevise.merge import rebase, MergeConflict
 
 USAGE = """\
 Create branches for commits in @{upstream}..HEAD if their commit message
 subject starts with [<topic>] where <topic> is the desired branch name.
+
+Run "git branchstack graph" to print the dependencies between topics.
+Run "git branchstack pick <base>..<commit>" to integrate other commits.
+Run "git branchstack list-branches" to list topics and their status.
 """
 
 SUBJECT_PREFIX_PREFIX = b"["
@@ -27,6 +48,197 @@ TrimSubject = bool
 Dependency = Tuple[str, TrimSubject]
 Dependencies = Dict[str, Dependency]
 
+# Maps each topic to all of its dependencies, including itself.
+DependencyClosures = Dict[str, Dependencies]
+
+# Maps (new parent, original commit, keep tag) to the rebased commit.
+RebaseMemo = Dict[Tuple[Oid, str, bool], Commit]
+# Persistent version of the above, in least recently used order.
+RebaseCache = Dict[Tuple[str, str, bool], str]
+
+# Maximum number of entries kept in the persistent rebase cache.
+REBASE_CACHE_SIZE = 10000
+
+# Maps commits to their patch ID, or None if they change nothing.
+PatchIdCache = Dict[str, Optional[str]]
+
+# Maximum number of entries kept in the persistent patch ID cache.
+PATCH_ID_CACHE_SIZE = 100000
+
+# Maps a conflict, identified by path and the base, current and other
+# blobs, to the blob it was resolved with, in least recently used order.
+Resolutions = Dict[Tuple[str, str, str, str], str]
+
+# Maximum number of entries kept in the persistent conflict resolutions.
+RESOLUTION_CACHE_SIZE = 10000
+
+# How many bytes of git-log output to read at once.
+LOG_CHUNK_SIZE = 64 * 1024
+
+# How many objects to request from git-cat-file before reading responses.
+# The requests must fit into the pipe buffer, or we would deadlock.
+PREFETCH_CHUNK_SIZE = 256
+
+# How often to check for changes with --watch, in seconds.
+WATCH_INTERVAL = 0.5
+# How long changes must settle before we rebuild, in seconds.
+WATCH_DEBOUNCE = 0.2
+
+# Total size of persisted trees and blobs to keep in memory.
+OBJECT_CACHE_SIZE = 256 * 1024 * 1024
+
+class Profiler:
+    """
+    Records the wall time of phases and of git subprocesses.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # (name, detail, category, start, end)
+        self.events: List[Tuple[str, Optional[str], str, float, float]] = []
+
+    def summary(self) -> List[Tuple[str, int, float, float]]:
+        """
+        Returns the number of calls, total and maximum time of each
+        phase, most expensive first.
+        """
+        totals: Dict[str, Tuple[int, float, float]] = {}
+        for name, _, _, start, end in self.events:
+            calls, total, longest = totals.get(name, (0, 0.0, 0.0))
+            totals[name] = (calls + 1, total + end - start, max(longest, end - start))
+        return sorted(
+            ((name, *values) for name, values in totals.items()),
+            key=lambda row: row[2],
+            reverse=True,
+        )
+
+    def print_table(self, file) -> None:
+        width = max([len("phase")] + [len(name) for name, _, _, _, _ in self.events])
+        print(f"{'phase':<{width}} {'calls':>6} {'total':>9} {'max':>9}", file=file)
+        for name, calls, total, longest in self.summary():
+            print(f"{name:<{width}} {calls:>6} {total:>8.3f}s {longest:>8.3f}s", file=file)
+        print(
+            f"{'wall time':<{width}} {'':>6} {time.perf_counter() - self.start:>8.3f}s",
+            file=file,
+        )
+
+    def write_trace(self, path) -> None:
+        """
+        Writes the recorded events in Chrome's trace event format.
+        """
+        events = []
+        for name, detail, category, start, end in self.events:
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.start) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": 0,
+            }
+            if detail is not None:
+                event["args"] = {"detail": detail}
+            events.append(event)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+PROFILER: Optional[Profiler] = None
+
+@contextmanager
+def phase(name, detail=None, category="phase"):
+    """
+    Records the time spent in the body, if profiling is enabled.
+    """
+    if PROFILER is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROFILER.events.append((name, detail, category, start, time.perf_counter()))
+
+UNPROFILED_GIT = Repository.git
+
+def profiled_git(self, *cmd, **kwargs):
+    with phase(f"git {cmd[0]}", " ".join(map(str, cmd)), "git"):
+        return UNPROFILED_GIT(self, *cmd, **kwargs)
+
+def enable_profiling() -> Profiler:
+    """
+    Starts recording phases, and every git command run via Repository.git.
+    """
+    global PROFILER
+    PROFILER = Profiler()
+    Repository.git = profiled_git
+    return PROFILER
+
+def disable_profiling() -> None:
+    global PROFILER
+    PROFILER = None
+    Repository.git = UNPROFILED_GIT
+
+def read_log(repo, *args) -> Iterator[str]:
+    """
+    Yields the NUL-separated records printed by "git log -z", as soon as
+    they arrive.
+    """
+    cmd = ("git", "log", "-z", *args)
+    with phase("git log", " ".join(cmd), "git"), Popen(
+        cmd, stdout=PIPE, cwd=repo.workdir
+    ) as process:
+        pending = b""
+        while True:
+            chunk = process.stdout.read1(LOG_CHUNK_SIZE)
+            if not chunk:
+                break
+            records = (pending + chunk).split(b"\0")
+            pending = records.pop()
+            for record in records:
+                yield record.decode()
+        if pending:
+            yield pending.decode()
+    if process.returncode != 0:
+        raise CalledProcessError(process.returncode, cmd)
+
+def parse_subject(
+    prefix_prefix, prefix_suffix, entry
+) -> Optional[Tuple[str, Optional[str], str, List[Dependency]]]:
+    """
+    Parses a "<commit> <subject>" line into commit ID, topic, subject
+    (without topic tag) and parent topics. Commits without topic tag have
+    no topic.
+    """
+    tmp = entry.split(maxsplit=1)
+    if len(tmp) != 2:
+        return None
+    commit, raw_subject = tmp
+    raw_subject = raw_subject.strip()
+    words = raw_subject.split(maxsplit=1)
+    if len(words) < 2:
+        return commit, None, raw_subject, []
+    prefix, subject = words
+    if not prefix.startswith(prefix_prefix) or not prefix.endswith(prefix_suffix):
+        return commit, None, raw_subject, []
+
+    prefix = prefix[len(prefix_prefix) : -len(prefix_suffix)]
+    topic_with_parents = prefix.split(":")
+    topic = topic_with_parents[0]
+    parent_topics = [parse_parent_topic(t) for t in topic_with_parents[1:] if t]
+    return commit, topic, subject, parent_topics
+
+def iter_log(
+    repo, prefix_prefix, prefix_suffix, *args
+) -> Iterator[Tuple[str, Optional[str], str, List[Dependency]]]:
+    """
+    Yields the parsed subject of every commit listed by "git log <args>".
+    """
+    for entry in read_log(repo, "--format=%H %s", *args):
+        parsed = parse_subject(prefix_prefix, prefix_suffix, entry)
+        if parsed is not None:
+            yield parsed
+
 def parse_log(
     repo, prefix_prefix, prefix_suffix, *args
 ) -> Tuple[CommitEntries, Dependencies]:
@@ -35,32 +247,12 @@ def parse_log(
     if "--reverse" not in args:
         dependency_graph = None
     include_others = "--reverse" not in args
-    patches = repo.git("log", "-z", "--format=%H %B", *args).decode().split("\x00")
-    for entry in patches:
-        tmp = entry.split(maxsplit=1)
-        if len(tmp) != 2:
-            continue
-        commit, message = tmp
-        raw_subject = message.split("\n\n", maxsplit=1)[0].strip()
-        words = raw_subject.split(maxsplit=1)
-        if len(words) < 2:
-            if include_others:
-                commit_entries += [(commit, None, raw_subject)]
-            continue
-        prefix, subject = words
-        if not prefix.startswith(prefix_prefix) or not prefix.endswith(prefix_suffix):
-            if include_others:
-                commit_entries += [(commit, None, raw_subject)]
-            continue
-
-        prefix = prefix[len(prefix_prefix) : -len(prefix_suffix)]
-        topic_with_parents = prefix.split(":")
-        topic = topic_with_parents[0]
-        parent_topics = [parse_parent_topic(t) for t in topic_with_parents[1:] if t]
-
+    for commit, topic, subject, parent_topics in iter_log(
+        repo, prefix_prefix, prefix_suffix, *args
+    ):
         if not topic:
             if include_others:
-                commit_entries += [(commit, "", subject)]
+                commit_entries += [(commit, topic, subject)]
             continue
 
         commit_entries += [(commit, topic, subject)]
@@ -81,20 +273,163 @@ def parse_parent_topic(topic: str) -> Dependency:
     return (topic, keep_tag)
 
 def transitive_dependencies(depgraph: Dependencies, node: Dependency) -> Dependencies:
-    visited: Dependencies = {}
-    transitive_dependencies_rec(depgraph, node, visited)
-    return visited
-
-def transitive_dependencies_rec(
-    depgraph: Dependencies, node: Dependency, visited: Dependencies
-) -> None:
     name, keep_tag = node
-    if name in visited:
-        return
+    visited = dict(dependency_closures(depgraph).get(name, {}))
     visited[name] = keep_tag
-    if name in depgraph:
-        for x in depgraph[name].items():
-            transitive_dependencies_rec(depgraph, x, visited)
+    return visited
+
+def dependency_closures(dependency_graph: Dependencies) -> DependencyClosures:
+    """
+    Returns the transitive dependencies of every topic in the graph, in a
+    single pass over the topics in topological order. Each topic's closure
+    is assembled from those of its direct dependencies, in the same order
+    as a depth-first search would visit them, so the first path to reach
+    a dependency decides whether its topic tag is kept.
+    """
+    closures: DependencyClosures = {}
+    for topic in topological_order(dependency_graph):
+        closure = {topic: False}
+        for dependency, keep_tag in dependency_graph[topic].items():
+            if dependency in closure:
+                continue
+            closure[dependency] = keep_tag
+            for t, k in closures.get(dependency, {}).items():
+                if t not in closure:
+                    closure[t] = k
+        closures[topic] = closure
+    return closures
+
+def topological_order(dependency_graph: Dependencies) -> List[str]:
+    """
+    Orders the topics in the graph such that each topic comes after its
+    dependencies, and otherwise keeps the original order. Raises
+    DependencyCycleError if topics depend on each other.
+    """
+    order: List[str] = []
+    visited: Set[str] = set()
+    for root in dependency_graph:
+        if root in visited:
+            continue
+        stack = [(root, iter(dependency_graph[root]))]
+        path = [root]
+        on_path = {root}
+        visited.add(root)
+        while stack:
+            topic, dependencies = stack[-1]
+            for dependency in dependencies:
+                if dependency == topic or dependency not in dependency_graph:
+                    continue
+                if dependency not in visited:
+                    visited.add(dependency)
+                    stack.append((dependency, iter(dependency_graph[dependency])))
+                    path.append(dependency)
+                    on_path.add(dependency)
+                    break
+                if dependency in on_path:
+                    raise DependencyCycleError(
+                        path[path.index(dependency) :] + [dependency]
+                    )
+            else:
+                stack.pop()
+                on_path.remove(path.pop())
+                order.append(topic)
+    return order
+
+class PathIndex:
+    """
+    Maps the paths changed in a range of commits to the commits that
+    changed them. The index is built with a single git-log call, the
+    first time it is used.
+    """
+
+    def __init__(self, repo, prefix_prefix, prefix_suffix, revision_range):
+        self.repo = repo
+        self.prefix_prefix = prefix_prefix
+        self.prefix_suffix = prefix_suffix
+        self.revision_range = revision_range
+        self._commit_entries: Optional[CommitEntries] = None
+        self._positions: Dict[str, int] = {}
+        self._paths: Dict[str, List[str]] = {}
+        self._commits_by_path: Dict[str, List[int]] = {}
+        self._commits_by_directory: Dict[str, List[int]] = {}
+
+    def _build(self) -> CommitEntries:
+        if self._commit_entries is not None:
+            return self._commit_entries
+        self._commit_entries = []
+        commit = None
+        for record in read_log(
+            self.repo,
+            "--reverse",
+            "--name-only",
+            "--no-renames",
+            "--format=%x01%H %s",
+            self.revision_range,
+        ):
+            if record.startswith("\x01"):
+                entry = record[len("\x01") :]
+                parsed = parse_subject(self.prefix_prefix, self.prefix_suffix, entry)
+                if parsed is None:  # empty commit message
+                    commit, topic, subject = entry.split(maxsplit=1)[0], None, ""
+                else:
+                    commit, topic, subject, _ = parsed
+                self._positions[commit] = len(self._commit_entries)
+                self._commit_entries.append((commit, topic, subject))
+                self._paths[commit] = []
+                continue
+            path = record.lstrip("\n")
+            if commit is None or not path:
+                continue
+            position = self._positions[commit]
+            self._paths[commit].append(path)
+            self._commits_by_path.setdefault(path, []).append(position)
+            for directory in parent_directories(path):
+                self._commits_by_directory.setdefault(directory, []).append(position)
+        return self._commit_entries
+
+    def position(self, commit) -> int:
+        """
+        Returns the index of the given commit in the range, oldest first.
+        """
+        self._build()
+        return self._positions[commit]
+
+    def paths(self, commit) -> List[str]:
+        """
+        Returns the paths changed by the given commit.
+        """
+        self._build()
+        return self._paths.get(commit, [])
+
+    def commits_before(self, commit, path) -> CommitEntries:
+        """
+        Returns the commits that changed the given path before the given
+        commit, oldest first.
+        """
+        commit_entries = self._build()
+        position = self._positions[commit]
+        return [
+            commit_entries[i]
+            for i in self._commits_by_path.get(path, ())
+            if i < position
+        ]
+
+    def overlapping_commits(self, path) -> Set[int]:
+        """
+        Returns the positions of commits that changed the given path, a
+        file at one of its parent directories, or a file below it.
+        """
+        self._build()
+        positions = set(self._commits_by_path.get(path, ()))
+        positions.update(self._commits_by_directory.get(path, ()))
+        for directory in parent_directories(path):
+            positions.update(self._commits_by_path.get(directory, ()))
+        return positions
+
+def parent_directories(path) -> Iterator[str]:
+    while "/" in path:
+        path = path.rsplit("/", maxsplit=1)[0]
+        yield path
 
 class BranchWasModifiedError(Exception):
     pass
@@ -105,74 +440,428 @@ class InvalidRangeError(Exception):
 class TopicNotFoundError(Exception):
     pass
 
-def validate_cache(repo, topic_set, force):
+class DependencyCycleError(Exception):
+    pass
+
+def read_cache(repo) -> Dict[str, Tuple[str, Optional[str]]]:
+    """
+    Returns the branch and fingerprint that each topic had after the
+    last run. Old caches do not record fingerprints.
+    """
     cache_path = repo.gitdir / "branchstack-cache"
     if not os.path.exists(cache_path):
-        return
-    cached_shas = [
-        (w[0], w[1])
-        for w in map(
-            lambda line: line.split(), cache_path.read_bytes().decode().splitlines()
-        )
-    ]
+        return {}
+    cache = {}
+    for line in cache_path.read_bytes().decode().splitlines():
+        w = line.split()
+        if len(w) < 2:
+            continue
+        cache[w[0]] = (w[1], w[2] if len(w) > 2 else None)
+    return cache
+
+def read_branches(repo, topics) -> Dict[str, str]:
+    """
+    Returns the current commit of each existing branch for the given topics.
+    """
     existing_branches = {}
+    if not topics:
+        return existing_branches
     refs = repo.git(
         "for-each-ref",
         "--format",
-        "%(refname:short) %(objectname)",
-        *[f"refs/heads/{t[0]}" for t in cached_shas],
+        "%(refname) %(objectname)",
+        *[f"refs/heads/{t}" for t in topics],
     )
     for line in refs.decode().splitlines():
         refname, sha = line.split(" ", maxsplit=1)
-        existing_branches[refname] = sha
-    for topic, cached_sha in cached_shas:
+        existing_branches[refname[len("refs/heads/") :]] = sha
+    return existing_branches
+
+def validate_cache(
+    repo, topic_set, force, existing_branches
+) -> Dict[str, Tuple[str, Optional[str]]]:
+    """
+    Returns the cache entries of the requested topics whose branch has
+    not been modified since the last run.
+    """
+    unmodified = {}
+    for topic, (cached_sha, fingerprint) in read_cache(repo).items():
         if topic not in existing_branches:
             continue
         if topic not in topic_set:  # The user did not ask to create this branch.
             continue
         current_sha = existing_branches[topic]
         if current_sha == cached_sha:
+            unmodified[topic] = (cached_sha, fingerprint)
             continue
         if force:
             print(f"Will overwrite modified branch {topic}")
         else:
             raise BranchWasModifiedError(topic)
+    return unmodified
 
-def update_cache(repo, topics):
+def update_cache(repo, topics, fingerprints):
     cache_path = repo.gitdir / "branchstack-cache"
-    mode = "rb+" if cache_path.exists() else "wb+"
-    with open(cache_path, mode) as f:
-        cached_shas = {
-            w[0]: w[1] for w in map(lambda line: line.split(), f.read().decode().splitlines())
-        }
-        new_topics = cached_shas
-        for t in topics:
-            if topics[t] is not None:
-                new_topics[t] = topics[t]
-        new_content = ""
-        for topic in new_topics:
-            sha = new_topics[topic]
-            if sha is not None:
-                new_content += f"{topic} {sha}{os.linesep}"
-        f.seek(0)
-        f.truncate()
-        f.write(new_content.encode())
-
-def trimmed_message(subject: str, message: bytes) -> str:
-    body = b"\n".join(message.split(b"\n\n", maxsplit=1)[1:])
-    if body:
-        return subject.encode() + b"\n\n" + body
-    return subject.encode()
+    new_topics = read_cache(repo)
+    for t in topics:
+        if topics[t] is not None:
+            new_topics[t] = (topics[t], fingerprints.get(t))
+    new_content = ""
+    for topic, (sha, fingerprint) in new_topics.items():
+        if fingerprint is None:
+            new_content += f"{topic} {sha}{os.linesep}"
+        else:
+            new_content += f"{topic} {sha} {fingerprint}{os.linesep}"
+    cache_path.write_bytes(new_content.encode())
 
-def create_branches(
-    repo,
-    current_branch,
-    base_commit,
-    tip="HEAD",
-    branches=None,
-    force=False,
-    keep_tags=None,
+def group_by_topic(commit_entries: CommitEntries) -> Dict[str, CommitEntries]:
+    """
+    Groups commits by topic. Topics are ordered by their first commit.
+    """
+    commits_by_topic: Dict[str, CommitEntries] = {}
+    for commit_entry in commit_entries:
+        commits_by_topic.setdefault(commit_entry[1], []).append(commit_entry)
+    return commits_by_topic
+
+def topic_commits(commits_by_topic, deps, keep_tags, topic):
+    """
+    Yields the commits that make up the branch for the given topic,
+    along with whether their topic tag is kept.
+    """
+    for t in commits_by_topic:
+        if t not in deps:
+            continue
+        keep_tag = (
+            deps[t]
+            or (keep_tags == "dependencies" and t != topic)
+            or keep_tags == "all"
+        )
+        for commit, _, subject in commits_by_topic[t]:
+            yield commit, t, subject, keep_tag
+
+def topic_fingerprint(
+    prefix_prefix, prefix_suffix, keep_tags, base_commit_id, commits_by_topic, deps, topic
+) -> str:
+    """
+    Identifies all inputs to create_branch(), so we can tell if the
+    branch would be the same as in the last run without creating it.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(f"{prefix_prefix} {prefix_suffix} {base_commit_id}\n".encode())
+    for commit, t, subject, keep_tag in topic_commits(
+        commits_by_topic, deps, keep_tags, topic
+    ):
+        hasher.update(f"{commit} {keep_tag}\n".encode())
+    return hasher.hexdigest()
+
+def load_rebase_cache(repo) -> RebaseCache:
+    cache_path = repo.gitdir / "branchstack-rebase-cache"
+    rebase_cache: RebaseCache = OrderedDict()
+    if not os.path.exists(cache_path):
+        return rebase_cache
+    for line in cache_path.read_bytes().decode().splitlines():
+        w = line.split()
+        if len(w) != 4:
+            continue
+        parent, commit, mode, result = w
+        rebase_cache[(parent, commit, mode == "keep")] = result
+    return rebase_cache
+
+def save_rebase_cache(repo, rebase_cache: RebaseCache, rebase_memo: RebaseMemo):
+    for (parent_oid, commit, keep_tag), head in rebase_memo.items():
+        key = (parent_oid.hex(), commit, keep_tag)
+        rebase_cache[key] = head.oid.hex()
+        rebase_cache.move_to_end(key)
+    while len(rebase_cache) > REBASE_CACHE_SIZE:
+        rebase_cache.popitem(last=False)
+    new_content = ""
+    for (parent, commit, keep_tag), result in rebase_cache.items():
+        mode = "keep" if keep_tag else "trim"
+        new_content += f"{parent} {commit} {mode} {result}{os.linesep}"
+    (repo.gitdir / "branchstack-rebase-cache").write_bytes(new_content.encode())
+
+def lookup_rebase_cache(
+    repo, rebase_cache: RebaseCache, memo_key, patch: Commit, message: bytes
+) -> Optional[Commit]:
+    """
+    Returns the commit created by a previous run, unless it has been
+    garbage-collected or does not match what we would create today.
+    """
+    parent_oid, commit, keep_tag = memo_key
+    key = (parent_oid.hex(), commit, keep_tag)
+    if key not in rebase_cache:
+        return None
+    try:
+        cached = repo.get_commit(Oid.fromhex(rebase_cache[key]))
+    except (MissingObject, ValueError):
+        del rebase_cache[key]
+        return None
+    if (
+        cached.parent_oids != [parent_oid]
+        or cached.message != message
+        or cached.author != patch.author
+        or cached.committer != patch.committer
+    ):
+        del rebase_cache[key]
+        return None
+    rebase_cache.move_to_end(key)
+    return cached
+
+def load_patch_id_cache(repo) -> PatchIdCache:
+    cache_path = repo.gitdir / "branchstack-patch-ids"
+    patch_id_cache: PatchIdCache = OrderedDict()
+    if not os.path.exists(cache_path):
+        return patch_id_cache
+    for line in cache_path.read_bytes().decode().splitlines():
+        w = line.split()
+        if len(w) != 2:
+            continue
+        commit, patch_id = w
+        patch_id_cache[commit] = None if patch_id == "-" else patch_id
+    return patch_id_cache
+
+def save_patch_id_cache(repo, patch_id_cache: PatchIdCache):
+    while len(patch_id_cache) > PATCH_ID_CACHE_SIZE:
+        patch_id_cache.popitem(last=False)
+    new_content = ""
+    for commit, patch_id in patch_id_cache.items():
+        new_content += f"{commit} {patch_id or '-'}{os.linesep}"
+    (repo.gitdir / "branchstack-patch-ids").write_bytes(new_content.encode())
+
+def load_resolutions(repo) -> Resolutions:
+    cache_path = repo.gitdir / "branchstack-resolutions"
+    resolutions: Resolutions = OrderedDict()
+    if not os.path.exists(cache_path):
+        return resolutions
+    for line in cache_path.read_bytes().decode().splitlines():
+        w = line.split(" ", maxsplit=4)
+        if len(w) != 5:
+            continue
+        base, current, other, resolved, path = w
+        resolutions[(path, base, current, other)] = resolved
+    return resolutions
+
+def save_resolutions(repo, resolutions: Resolutions):
+    while len(resolutions) > RESOLUTION_CACHE_SIZE:
+        resolutions.popitem(last=False)
+    new_content = ""
+    for (path, base, current, other), resolved in resolutions.items():
+        new_content += f"{base} {current} {other} {resolved} {path}{os.linesep}"
+    (repo.gitdir / "branchstack-resolutions").write_bytes(new_content.encode())
+
+def use_resolutions(repo) -> Resolutions:
+    """
+    Makes conflict resolutions from earlier runs available to
+    override_merge_blobs(). Returns them, so the caller can tell if
+    there are new ones to save.
+    """
+    resolutions = load_resolutions(repo)
+    RESOLUTIONS.clear()
+    RESOLUTIONS.update(resolutions)
+    return resolutions
+
+def patch_ids(repo, commits, patch_id_cache: PatchIdCache) -> Dict[str, Optional[str]]:
+    """
+    Returns the stable patch ID of each of the given commits, see
+    git-patch-id(1).  Commits missing from the cache are diffed with a
+    single "git diff-tree --stdin | git patch-id" pipeline.
+    """
+    missing = [commit for commit in commits if commit not in patch_id_cache]
+    if missing:
+        import tempfile
+
+        diff_cmd = ("git", "diff-tree", "--stdin", "-p", "--root")
+        patch_id_cmd = ("git", "patch-id", "--stable")
+        with phase("git patch-id", f"{len(missing)} commits", "git"):
+            # Both pipes could fill up if we fed stdin ourselves.
+            with tempfile.TemporaryFile() as stdin:
+                stdin.write("".join(f"{commit}\n" for commit in missing).encode())
+                stdin.seek(0)
+                with Popen(
+                    diff_cmd, stdin=stdin, stdout=PIPE, cwd=repo.workdir
+                ) as diff, Popen(
+                    patch_id_cmd, stdin=diff.stdout, stdout=PIPE, cwd=repo.workdir
+                ) as patch_id:
+                    diff.stdout.close()
+                    output = patch_id.communicate()[0]
+        if diff.returncode != 0:
+            raise CalledProcessError(diff.returncode, diff_cmd)
+        if patch_id.returncode != 0:
+            raise CalledProcessError(patch_id.returncode, patch_id_cmd)
+        computed = dict(line.split()[::-1] for line in output.decode().splitlines())
+        for commit in missing:
+            # Commits without changes, like merges, have no patch ID.
+            patch_id_cache[commit] = computed.get(commit)
+    result = {}
+    for commit in commits:
+        patch_id_cache.move_to_end(commit)
+        result[commit] = patch_id_cache[commit]
+    return result
+
+def trimmed_message(message: bytes) -> bytes:
+    """
+    Drops the topic tag from the subject of the given commit message.
+    """
+    subject, *body = message.split(b"\n\n", maxsplit=1)
+    subject = subject.strip().split(maxsplit=1)[1]
+    if body and body[0]:
+        return subject + b"\n\n" + body[0]
+    return subject
+
+OBJECT_TYPES = {b"commit": Commit, b"tree": Tree, b"blob": Blob}
+
+def prefetch_objects(repo, oids) -> List[Oid]:
+    """
+    Loads the given objects into the object cache, without waiting for
+    each response from git-cat-file before sending the next request.
+    Returns the objects that were actually read.
+    """
+    wanted = [
+        oid for oid in dict.fromkeys(oids) if oid not in repo._objects[oid[0]]
+    ]
+    stdin, stdout = repo._catfile.stdin, repo._catfile.stdout
+    for i in range(0, len(wanted), PREFETCH_CHUNK_SIZE):
+        chunk = wanted[i : i + PREFETCH_CHUNK_SIZE]
+        stdin.write(b"".join(oid.hex().encode() + b"\n" for oid in chunk))
+        stdin.flush()
+        for _ in chunk:
+            header = stdout.readline().split()
+            if header[-1] == b"missing":
+                continue
+            kind, size = header[1], int(header[2])
+            body = stdout.read(size + 1)[:-1]
+            OBJECT_TYPES[kind](repo, body).persisted = True
+    return wanted
+
+def prefetch_topics(
+    repo, base_commit_id, commits_by_topic, closures, topics
 ) -> None:
+    """
+    Loads the commits needed to build the given topics, along with their
+    parents and trees, in a few round trips.
+    """
+    needed: Set[str] = set()
+    for topic in topics:
+        needed.update(closures[topic])
+    commit_ids = [Oid.fromhex(base_commit_id)] + [
+        Oid.fromhex(commit)
+        for topic in commits_by_topic
+        if topic in needed
+        for commit, _, _ in commits_by_topic[topic]
+    ]
+    prefetch_objects(repo, commit_ids)
+    commits = [repo.get_commit(oid) for oid in commit_ids]
+    prefetch_objects(repo, (oid for commit in commits for oid in commit.parent_oids))
+    commits += [commit.parent() for commit in commits if not commit.is_root]
+    prefetch_objects(repo, (commit.tree_oid for commit in commits))
+
+PACK_OBJECT_TYPES = {Commit: 1, Tree: 2, Blob: 3}
+
+def unpersisted_objects(roots) -> List[GitObj]:
+    """
+    Returns the objects reachable from the given ones that have not been
+    written to the object database yet.
+    """
+    objects: Dict[Oid, GitObj] = {}
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if obj.persisted or obj.oid in objects:
+            continue
+        objects[obj.oid] = obj
+        if isinstance(obj, Commit):
+            stack.append(obj.tree())
+            stack.extend(obj.parents())
+        elif isinstance(obj, Tree):
+            stack.extend(
+                obj.repo.get_obj(entry.oid)
+                for entry in obj.entries.values()
+                if entry.mode != Mode.GITLINK
+            )
+    return list(objects.values())
+
+def pack_object_header(obj_type, size) -> bytes:
+    header = bytearray()
+    byte = (obj_type << 4) | (size & 0x0F)
+    size >>= 4
+    while size:
+        header.append(byte | 0x80)
+        byte = size & 0x7F
+        size >>= 7
+    header.append(byte)
+    return bytes(header)
+
+def write_pack(repo, roots) -> None:
+    """
+    Writes all new objects reachable from the given ones into a single
+    packfile, instead of one loose object per "git hash-object" call.
+    """
+    objects = unpersisted_objects(roots)
+    if not objects:
+        return
+    chunks = [b"PACK", struct.pack(">II", 2, len(objects))]
+    for obj in objects:
+        chunks.append(pack_object_header(PACK_OBJECT_TYPES[type(obj)], len(obj.body)))
+        chunks.append(zlib.compress(obj.body, 1))
+    pack = b"".join(chunks)
+    repo.git("index-pack", "--stdin", stdin=pack + hashlib.sha1(pack).digest())
+    for obj in objects:
+        obj.persisted = True
+
+class ObjectCacheUsage:
+    """
+    Keeps a running total of the size of the trees and blobs in the
+    object cache of a repository. Only trim_object_cache() removes
+    objects from the cache, and new ones are appended, so we only need
+    to look at the objects added since the last update.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.size = 0
+        self.seen: Dict[int, int] = {}
+
+    def update(self) -> int:
+        for key, cache in self.repo._objects.items():
+            seen = self.seen.get(key, 0)
+            if len(cache) == seen:
+                continue
+            for obj in islice(cache.values(), seen, None):
+                if not isinstance(obj, Commit):
+                    self.size += len(obj.body)
+            self.seen[key] = len(cache)
+        return self.size
+
+OBJECT_CACHE_USAGE: Optional[ObjectCacheUsage] = None
+
+def trim_object_cache(repo, limit=None) -> None:
+    """
+    Drops persisted trees and blobs from the object cache once trees and
+    blobs take up more than the limit. They will be read again from
+    git-cat-file if needed.
+    """
+    global OBJECT_CACHE_USAGE
+    if limit is None:
+        limit = OBJECT_CACHE_SIZE
+    if OBJECT_CACHE_USAGE is None or OBJECT_CACHE_USAGE.repo is not repo:
+        OBJECT_CACHE_USAGE = ObjectCacheUsage(repo)
+    usage = OBJECT_CACHE_USAGE
+    if usage.update() <= limit:
+        return
+    evictable = [
+        (oid, obj)
+        for cache in repo._objects.values()
+        for oid, obj in cache.items()
+        if obj.persisted and not isinstance(obj, Commit)
+    ]
+    for oid, obj in evictable:
+        if usage.size <= limit:
+            break
+        del repo._objects[oid[0]][oid]
+        usage.size -= len(obj.body)
+    usage.seen = {key: len(cache) for key, cache in repo._objects.items()}
+
+def read_affixes(repo) -> Tuple[str, str]:
     prefix_prefix = repo.config(
         "branchstack.subjectPrefixPrefix",
         default=SUBJECT_PREFIX_PREFIX,
@@ -181,28 +870,234 @@ def create_branches(
         "branchstack.subjectPrefixSuffix",
         default=SUBJECT_PREFIX_SUFFIX,
     ).decode()
+    return prefix_prefix, prefix_suffix
+
+def load_topics(
+    repo, base_commit, tip, branches
+) -> Tuple[str, str, Dict[str, CommitEntries], Dependencies, PathIndex]:
+    """
+    Reads the topics in the given range for analyses that do not
+    create branches.
+    """
+    prefix_prefix, prefix_suffix = read_affixes(repo)
+    commit_entries, dependency_graph = parse_log(
+        repo, prefix_prefix, prefix_suffix, f"{base_commit}..{tip}", "--reverse"
+    )
+    commits_by_topic = group_by_topic(commit_entries)
+    for topic in branches or ():
+        if topic not in commits_by_topic:
+            raise TopicNotFoundError(topic, base_commit, tip)
+    path_index = PathIndex(repo, prefix_prefix, prefix_suffix, f"{base_commit}..{tip}")
+    return prefix_prefix, prefix_suffix, commits_by_topic, dependency_graph, path_index
+
+def check_dependencies(
+    repo, base_commit, tip="HEAD", branches=None
+) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Returns likely missing dependencies of each topic, without rebasing
+    anything. A topic likely depends on another topic if the other topic
+    changed a path before one of our commits changed it.
+    """
+    _, _, commits_by_topic, dependency_graph, path_index = load_topics(
+        repo, base_commit, tip, branches
+    )
+    closures = dependency_closures(dependency_graph)
+    missing = {}
+    for topic in commits_by_topic:
+        if branches and topic not in branches:
+            continue
+        deps = closures[topic]
+        missing_deps: Dict[str, List[str]] = {}
+        for commit, _, _, _ in topic_commits(commits_by_topic, deps, None, topic):
+            for path in path_index.paths(commit):
+                for _, t, _ in path_index.commits_before(commit, path):
+                    if not t or t in deps:
+                        continue
+                    paths = missing_deps.setdefault(t, [])
+                    if path not in paths:
+                        paths.append(path)
+        if missing_deps:
+            missing[topic] = missing_deps
+    return missing
+
+def predict_conflicts(
+    repo, base_commit, tip="HEAD", branches=None
+) -> Dict[str, List[str]]:
+    """
+    Returns the paths that may conflict when creating the branch of each
+    topic, without performing any merges. Topics without such paths are
+    guaranteed to apply cleanly.
+
+    When rebasing a commit, the new parent differs from the original
+    parent only in paths changed by commits that precede the commit in
+    exactly one of the original and the new history. If the commit
+    itself changes none of these paths, the merge is trivial.
+    """
+    _, _, commits_by_topic, dependency_graph, path_index = load_topics(
+        repo, base_commit, tip, branches
+    )
+    closures = dependency_closures(dependency_graph)
+    conflicts = {}
+    for topic in commits_by_topic:
+        if branches and topic not in branches:
+            continue
+        deps = closures[topic]
+        applied: Set[int] = set()
+        paths: List[str] = []
+        for commit, _, _, _ in topic_commits(commits_by_topic, deps, None, topic):
+            position = path_index.position(commit)
+            for path in path_index.paths(commit):
+                if path in paths:
+                    continue
+                if any(
+                    (i < position) != (i in applied)
+                    for i in path_index.overlapping_commits(path)
+                    if i != position
+                ):
+                    paths.append(path)
+            applied.add(position)
+        conflicts[topic] = paths
+    return conflicts
+
+def topic_graph(repo, base_commit, tip="HEAD", branches=None) -> Dict:
+    """
+    Describes the topics in the given range, their commits and the
+    dependencies between them. Topics are listed in topological order,
+    dependencies first. If branches are given, only those topics and
+    their dependencies are included.
+    """
+    _, _, commits_by_topic, dependency_graph, _ = load_topics(
+        repo, base_commit, tip, branches
+    )
+    closures = dependency_closures(dependency_graph)
+    order = topological_order(dependency_graph)
+    if branches:
+        selected = {t for topic in branches for t in closures[topic]}
+        order = [topic for topic in order if topic in selected]
+    topics = {}
+    for topic in order:
+        topics[topic] = {
+            "commits": [
+                {"commit": commit, "subject": subject}
+                for commit, _, subject in commits_by_topic[topic]
+            ],
+            "dependencies": [
+                {"topic": dependency, "keep_tag": keep_tag}
+                for dependency, keep_tag in dependency_graph[topic].items()
+            ],
+            "transitive_dependencies": [
+                t for t in order if t != topic and t in closures[topic]
+            ],
+            "missing_dependencies": [
+                t for t in closures[topic] if t not in dependency_graph
+            ],
+        }
+    return {
+        "base": base_commit,
+        "tip": repo.git("rev-parse", tip).decode(),
+        "order": order,
+        "topics": topics,
+    }
+
+def list_branches(
+    repo, base_commit, tip="HEAD", branches=None, keep_tags=None, upstream=None
+) -> List[Dict]:
+    """
+    Describes each topic in the given range, and whether its branch is
+    up-to-date, without creating any commits. This only runs git-log
+    once, so it is cheap enough for shell prompts, unless upstream is
+    given to compare against branches created with --skip-upstreamed.
+    """
+    prefix_prefix, prefix_suffix = read_affixes(repo)
     commit_entries, dependency_graph = parse_log(
         repo, prefix_prefix, prefix_suffix, f"{base_commit}..{tip}", "--reverse"
     )
-    def by_first_commit_on_topic(commit_entry):
-        (commit, topic, subject) = commit_entry
-        for i in range(len(commit_entries)):
-            if commit_entries[i][1] == topic:
-                return i
-        return -1
-    commit_entries.sort(key=by_first_commit_on_topic)
-    topics = {commit_entry[1]: None for commit_entry in commit_entries}
-    all_topics = set(topics)
+    onto = base_commit
+    if upstream is not None:
+        commit_entries, onto = skip_upstreamed(
+            repo, base_commit, upstream, commit_entries, quiet=True
+        )
+    commits_by_topic = group_by_topic(commit_entries)
+    for topic in branches or ():
+        if topic not in commits_by_topic:
+            raise TopicNotFoundError(topic, base_commit, tip)
+    topics = [t for t in commits_by_topic if not branches or t in branches]
+    closures = dependency_closures(dependency_graph)
+    base_commit_id = repo.git("rev-parse", onto).decode()
+    existing_branches = read_branches(repo, topics)
+    cache = read_cache(repo)
+    result = []
+    for topic in topics:
+        commits = commits_by_topic[topic]
+        if topic not in existing_branches:
+            status = "missing"
+        elif topic in cache and cache[topic][0] != existing_branches[topic]:
+            status = "modified"
+        elif topic in cache and cache[topic][1] == topic_fingerprint(
+            prefix_prefix,
+            prefix_suffix,
+            keep_tags,
+            base_commit_id,
+            commits_by_topic,
+            closures[topic],
+            topic,
+        ):
+            status = "up-to-date"
+        else:
+            status = "stale"
+        result.append(
+            {
+                "topic": topic,
+                "commits": len(commits),
+                "dependencies": list(dependency_graph[topic]),
+                "first_commit": commits[0][0],
+                "last_commit": commits[-1][0],
+                "status": status,
+            }
+        )
+    return result
+
+def create_branches(
+    repo,
+    current_branch,
+    base_commit,
+    tip="HEAD",
+    branches=None,
+    force=False,
+    keep_tags=None,
+    jobs=1,
+    pack=False,
+    rebase_memo: Optional[RebaseMemo] = None,
+    upstream: Optional[str] = None,
+) -> List[Dict]:
+    REBASE_STATS.update(spliced=0, merged=0)
+    with phase("read config"):
+        prefix_prefix, prefix_suffix = read_affixes(repo)
+    with phase("parse_log"):
+        commit_entries, dependency_graph = parse_log(
+            repo, prefix_prefix, prefix_suffix, f"{base_commit}..{tip}", "--reverse"
+        )
+        closures = dependency_closures(dependency_graph)
+    onto = base_commit
+    if upstream is not None:
+        with phase("skip upstreamed"):
+            commit_entries, onto = skip_upstreamed(
+                repo, base_commit, upstream, commit_entries
+            )
+    commits_by_topic = group_by_topic(commit_entries)
+    # Topics whose commits are all upstream are still known.
+    all_topics = set(dependency_graph)
     topic_set = all_topics
 
     if branches:
         for topic in branches:
             if topic not in all_topics:
                 raise TopicNotFoundError(topic, base_commit, tip)
-        topic_set = set()
-        for topic in branches:
-            topic_set.add(topic)
-        topics = {t: None for t in topics if t in topic_set}
+        topic_set = set(branches)
+    for topic in dependency_graph:
+        if topic in topic_set and topic not in commits_by_topic:
+            print(f"Skipping topic '{topic}', all of its commits are upstream.")
+    topics = {t: None for t in commits_by_topic if t in topic_set}
 
     for child in topics:
         for parent in dependency_graph[child]:
@@ -213,67 +1108,259 @@ def create_branches(
         topics
     ), f"Refusing to overwrite current branch {current_branch}"
 
-    base_commit_id = repo.git("rev-parse", base_commit).decode()
+    base_commit_id = repo.git("rev-parse", onto).decode()
 
-    validate_cache(repo, topic_set, force)
+    with phase("validate_cache"):
+        existing_branches = read_branches(repo, topics)
+        unmodified = validate_cache(repo, topic_set, force, existing_branches)
+    fingerprints = {}
+    if rebase_memo is None:
+        rebase_memo = {}
+    rebase_cache = load_rebase_cache(repo)
+    resolutions = use_resolutions(repo)
+    path_index = PathIndex(
+        repo, prefix_prefix, prefix_suffix, f"{base_commit_id}..{tip}"
+    )
     try:
+        outdated_topics = []
         for topic in topics:
-            create_branch(
-                repo,
+            fingerprints[topic] = topic_fingerprint(
                 prefix_prefix,
                 prefix_suffix,
                 keep_tags,
                 base_commit_id,
-                commit_entries,
-                topics,
-                dependency_graph,
+                commits_by_topic,
+                closures[topic],
                 topic,
             )
+            if topic in unmodified and unmodified[topic][1] == fingerprints[topic]:
+                topics[topic] = unmodified[topic][0]
+                continue
+            outdated_topics.append(topic)
+        if jobs <= 1:
+            with phase("prefetch"):
+                prefetch_topics(
+                    repo,
+                    base_commit_id,
+                    commits_by_topic,
+                    closures,
+                    outdated_topics,
+                )
+        heads = {}
+        if jobs > 1 and outdated_topics:
+            with phase("build_topics_in_parallel"):
+                heads = build_topics_in_parallel(
+                    repo,
+                    jobs,
+                    prefix_prefix,
+                    prefix_suffix,
+                    keep_tags,
+                    base_commit_id,
+                    commits_by_topic,
+                    closures,
+                    outdated_topics,
+                    rebase_cache,
+                    pack,
+                )
+        for topic in outdated_topics:
+            if topic in heads:
+                continue
+            with phase("build_topic", topic):
+                heads[topic] = build_topic(
+                    repo,
+                    prefix_prefix,
+                    prefix_suffix,
+                    keep_tags,
+                    base_commit_id,
+                    commits_by_topic,
+                    closures,
+                    topic,
+                    rebase_memo,
+                    rebase_cache,
+                    path_index,
+                )
+            trim_object_cache(repo)
+        if pack:
+            with phase("write pack"):
+                write_pack(repo, heads.values())
+        with phase("update refs"):
+            updated_topics = update_branches(repo, existing_branches, heads)
+        for topic, head in heads.items():
+            topics[topic] = head.oid.hex()
     finally:
-        update_cache(repo, topics)
+        with phase("write caches"):
+            update_cache(repo, topics, fingerprints)
+            save_rebase_cache(repo, rebase_cache, rebase_memo)
+            if RESOLUTIONS != resolutions:
+                save_resolutions(repo, RESOLUTIONS)
 
-    for topic in topics:
-        print(topic)
-        for line in (
-            repo.git("log", f"{base_commit}..refs/heads/{topic}", "--oneline")
-            .decode()
-            .splitlines()
+    with phase("topic report"):
+        return [
+            topic_report(
+                repo, base_commit_id, topic, topics[topic], topic in updated_topics
+            )
+            for topic in topics
+        ]
+
+def topic_report(repo, base_commit_id, topic, head_oid, updated) -> Dict:
+    """
+    Describes the branch of the given topic, without running git-log.
+    """
+    commits = []
+    oid = Oid.fromhex(head_oid)
+    base_oid = Oid.fromhex(base_commit_id)
+    while oid != base_oid:
+        commit = repo.get_commit(oid)
+        commits.append({"commit": oid.hex(), "subject": commit.summary()})
+        if commit.is_root:
+            break
+        oid = commit.parent_oids[0]
+    return {
+        "topic": topic,
+        "head": head_oid,
+        "updated": updated,
+        "commits": commits,
+    }
+
+def skip_upstreamed(
+    repo, base_commit, upstream, commit_entries, quiet=False
+) -> Tuple[CommitEntries, str]:
+    """
+    Drops the commits whose patch ID matches a commit in
+    <base_commit>..<upstream>, for example after a maintainer applied
+    them with a different message. Returns the remaining commits and the
+    commit to build them on: if any commit was dropped, later commits may
+    depend on its upstream version, so that is <upstream>.
+    """
+    patch_id_cache = load_patch_id_cache(repo)
+    upstream_commits = list(
+        read_log(repo, "--format=%H", "--no-merges", f"{base_commit}..{upstream}")
+    )
+    if not upstream_commits:
+        return commit_entries, base_commit
+    commits = [commit for commit, _, _ in commit_entries]
+    ids = patch_ids(repo, upstream_commits + commits, patch_id_cache)
+    save_patch_id_cache(repo, patch_id_cache)
+    upstreamed = {ids[commit] for commit in upstream_commits} - {None}
+    kept = []
+    for entry in commit_entries:
+        if ids[entry[0]] in upstreamed:
+            if not quiet:
+                print(f"Skipping commit {entry[0][:7]} {entry[2]}, it is upstream.")
+            continue
+        kept.append(entry)
+    if len(kept) == len(commit_entries):
+        return commit_entries, base_commit
+    return kept, upstream
+
+def print_report(report, report_format, rebase_stats=None):
+    if report_format == "json":
+        output = {"topics": report}
+        if rebase_stats is not None:
+            output["rebase"] = rebase_stats
+        json.dump(output, sys.stdout, indent=2)
+        print()
+        return
+    for topic_report in report:
+        print(topic_report["topic"])
+        for commit in topic_report["commits"]:
+            print("\t", f"{commit['commit'][:7]} {commit['subject']}")
+
+def splice_trees(current: Tree, base: Tree, other: Tree) -> Optional[Tree]:
+    """
+    Applies the changes from base to other on top of current, by reusing
+    whole subtrees. Returns None if some path was changed on both sides,
+    in which case a real merge is needed.
+    """
+    if current == base or current == other:
+        return other
+    if other == base:
+        return current
+    entries = {}
+    for name in set(current.entries).union(base.entries, other.entries):
+        current_entry = current.entries.get(name)
+        base_entry = base.entries.get(name)
+        other_entry = other.entries.get(name)
+        if base_entry == current_entry:
+            merged = other_entry
+        elif base_entry == other_entry or current_entry == other_entry:
+            merged = current_entry
+        elif all(
+            entry is not None and entry.mode == Mode.DIR
+            for entry in (current_entry, base_entry, other_entry)
         ):
-            print("\t", line)
+            subtree = splice_trees(
+                current_entry.tree(), base_entry.tree(), other_entry.tree()
+            )
+            if subtree is None:
+                return None
+            merged = Entry(current.repo, Mode.DIR, subtree.oid)
+        else:
+            return None
+        if merged is not None:
+            entries[name] = merged
+    return current.repo.new_tree(entries)
 
-def create_branch(
+def rebased_tree(patch: Commit, head: Commit) -> Tree:
+    """
+    Returns the tree of the given commit rebased onto head. Most commits
+    change paths that are untouched between their original parent and
+    head, so try splicing trees before running a full merge.
+    """
+    repo = patch.repo
+    parent_tree = patch.parent().tree() if not patch.is_root else Tree(repo, b"")
+    tree = splice_trees(head.tree(), parent_tree, patch.tree())
+    if tree is not None:
+        REBASE_STATS["spliced"] += 1
+        return tree
+    REBASE_STATS["merged"] += 1
+    # Only take over file merges from gitrevise when we need them, so
+    # importing this module has no side effects.
+    merge.merge_blobs = override_merge_blobs
+    return rebase(patch, head).tree()
+
+def build_topic(
     repo,
     prefix_prefix,
     prefix_suffix,
     keep_tags,
     base_commit_id,
-    commit_entries,
-    topics,
-    dependency_graph,
+    commits_by_topic,
+    closures,
     topic,
-):
+    rebase_memo: RebaseMemo,
+    rebase_cache: RebaseCache,
+    path_index: Optional[PathIndex],
+) -> Commit:
     head = repo.get_commit(base_commit_id)
-    deps = transitive_dependencies(dependency_graph, (topic, False))
-    for commit, t, subject in commit_entries:
-        if t not in deps:
+    deps = closures[topic]
+    for commit, t, subject, keep_tag in topic_commits(
+        commits_by_topic, deps, keep_tags, topic
+    ):
+        # Topics that share a dependency also share the prefix of their
+        # history, so only rebase each commit once per new parent.
+        memo_key = (head.oid, commit, keep_tag)
+        if memo_key in rebase_memo:
+            head = rebase_memo[memo_key]
             continue
-        keep_tag = deps[t]
         patch = repo.get_commit(commit)
+        if keep_tag:
+            message = patch.message
+        else:
+            message = trimmed_message(patch.message)
+        cached = lookup_rebase_cache(repo, rebase_cache, memo_key, patch, message)
+        if cached is not None:
+            head = rebase_memo[memo_key] = cached
+            continue
         def on_conflict(path):
             """
             Some commit in "base_commit..commit~" must have touched the
             path as well, but is not among our dependencies.
             """
             print("Missing dependency on one of the commits below?")
-            log, _ = parse_log(
-                repo,
-                prefix_prefix,
-                prefix_suffix,
-                f"{base_commit_id}..{commit}~",
-                "--",
-                path,
-            )
-            for id, topic, subject in log:
+            for id, topic, subject in reversed(
+                path_index.commits_before(commit, str(path))
+            ):
                 if topic not in deps:
                     prefix = (
                         ""
@@ -283,35 +1370,263 @@ def create_branch(
                     print(f"\t{id[:7]} {prefix}{subject}")
         global ON_CONFLICT
         ON_CONFLICT = on_conflict
-        head = rebase(patch, head)
-        message = head.message
-        keep_tag = (
-            keep_tag
-            or (keep_tags == "dependencies" and t != topic)
-            or keep_tags == "all"
-        )
-        if not keep_tag:
-            message = trimmed_message(subject, patch.message)
+        with phase("rebase", commit):
+            tree = rebased_tree(patch, head)
         head = repo.new_commit(
             message=message,
-            tree=head.tree(),
-            parents=head.parents(),
-            author=head.author,
+            tree=tree,
+            parents=[head],
+            author=patch.author,
             committer=patch.committer,  # preserve original committer and timestamp
         )
-    topic_fqn = f"refs/heads/{topic}"
-    if not repo.git("branch", "--list", topic):
-        repo.git("branch", topic, base_commit_id)
-    topic_ref = repo.get_commit_ref(topic_fqn)
+        rebase_memo[memo_key] = head
+    return head
 
-    if head.oid != topic_ref.target.oid:
-        topic_oid = topic_ref.target.oid
-        print(f"Updating {topic_ref.name} ({topic_oid} => {head.oid})")
-        topic_ref.update(head, "git-branchstack rewrite")
+def update_branches(repo, existing_branches, heads: Dict[str, Commit]) -> Set[str]:
+    """
+    Points the branches of the given topics at the given commits, in a
+    single transaction.  If any branch is not where we expect it to be,
+    because it was changed since we looked at it, nothing is updated.
+    Returns the topics whose branch was changed.
+    """
+    updated_topics = set()
+    commands = ""
+    for topic, head in heads.items():
+        old_oid = existing_branches.get(topic)
+        if old_oid == head.oid.hex():
+            continue
+        head.persist()
+        if old_oid is None:
+            print(f"Creating refs/heads/{topic} ({head.oid})")
+            old_oid = Oid.null().hex()
+        else:
+            print(f"Updating refs/heads/{topic} ({old_oid} => {head.oid})")
+        commands += f"update refs/heads/{topic} {head.oid} {old_oid}\n"
+        updated_topics.add(topic)
+    if commands:
+        repo.git(
+            "update-ref",
+            "-m",
+            "git-branchstack rewrite",
+            "--stdin",
+            stdin=commands.encode(),
+        )
+    return updated_topics
 
-    topics[topic] = topic_ref.target.oid
+def topic_groups(closures, topics) -> List[List[str]]:
+    """
+    Partitions the given topics such that topics in different groups
+    have no dependencies in common, so they can be built independently.
+    """
+    representative: Dict[str, str] = {}
+    def find(topic):
+        while representative.setdefault(topic, topic) != topic:
+            topic = representative[topic]
+        return topic
+    for topic in topics:
+        for dependency in closures[topic]:
+            representative[find(dependency)] = find(topic)
+    groups: Dict[str, List[str]] = {}
+    for topic in topics:
+        groups.setdefault(find(topic), []).append(topic)
+    return list(groups.values())
+
+def build_topics_worker(
+    workdir,
+    prefix_prefix,
+    prefix_suffix,
+    keep_tags,
+    base_commit_id,
+    commits_by_topic,
+    closures,
+    topics,
+    rebase_cache: RebaseCache,
+    resolutions: Resolutions,
+    pack: bool,
+) -> Tuple[Dict[str, Optional[str]], RebaseCache, Resolutions, Dict[str, int]]:
+    """
+    Builds the given topics in a worker process. Since we cannot prompt
+    for conflict resolution here, topics with conflicts are reported
+    as None, so the caller can build them interactively.  Conflicts that
+    were resolved before are resolved the same way, and the resolutions
+    replayed from git-rerere are returned for the caller to save.
+    """
+    global INTERACTIVE
+    INTERACTIVE = False
+    merge.conflict_prompt = non_interactive_conflict_prompt
+    RESOLUTIONS.clear()
+    RESOLUTIONS.update(resolutions)
+    REBASE_STATS.update(spliced=0, merged=0)
+    heads = {}
+    built: List[Commit] = []
+    rebase_memo: RebaseMemo = {}
+    with Repository(workdir) as repo:
+        prefetch_topics(
+            repo, base_commit_id, commits_by_topic, closures, topics
+        )
+        for topic in topics:
+            try:
+                head = build_topic(
+                    repo,
+                    prefix_prefix,
+                    prefix_suffix,
+                    keep_tags,
+                    base_commit_id,
+                    commits_by_topic,
+                    closures,
+                    topic,
+                    rebase_memo,
+                    rebase_cache,
+                    None,
+                )
+            except MergeConflict:
+                heads[topic] = None
+                continue
+            if not pack:
+                head.persist()
+            heads[topic] = head.oid.hex()
+            built.append(head)
+            trim_object_cache(repo)
+        if pack:
+            write_pack(repo, built)
+    new_cache_entries = {
+        (parent_oid.hex(), commit, keep_tag): head.oid.hex()
+        for (parent_oid, commit, keep_tag), head in rebase_memo.items()
+        if head.persisted
+    }
+    new_resolutions = {
+        key: resolved
+        for key, resolved in RESOLUTIONS.items()
+        if resolutions.get(key) != resolved
+    }
+    return heads, new_cache_entries, new_resolutions, dict(REBASE_STATS)
+
+def build_topics_in_parallel(
+    repo,
+    jobs,
+    prefix_prefix,
+    prefix_suffix,
+    keep_tags,
+    base_commit_id,
+    commits_by_topic,
+    closures,
+    topics,
+    rebase_cache: RebaseCache,
+    pack=False,
+) -> Dict[str, Commit]:
+    """
+    Builds independent groups of topics in up to the given number of
+    worker processes. Topics that had conflicts are omitted from the
+    result, or cause an error if we cannot ask the user to resolve them.
+    """
+    # Starting worker processes is expensive anyway, but importing
+    # multiprocessing slows down every other run.
+    from concurrent.futures import ProcessPoolExecutor
+
+    groups = topic_groups(closures, topics)
+    groups.sort(key=len, reverse=True)
+    heads: Dict[str, Commit] = {}
+    with ProcessPoolExecutor(max_workers=min(jobs, len(groups))) as executor:
+        futures = [
+            executor.submit(
+                build_topics_worker,
+                repo.workdir,
+                prefix_prefix,
+                prefix_suffix,
+                keep_tags,
+                base_commit_id,
+                commits_by_topic,
+                closures,
+                group,
+                rebase_cache,
+                RESOLUTIONS,
+                pack,
+            )
+            for group in groups
+        ]
+        for future in futures:
+            group_heads, new_cache_entries, new_resolutions, stats = future.result()
+            for key, count in stats.items():
+                REBASE_STATS[key] += count
+            for topic, oid in group_heads.items():
+                if oid is None:
+                    if not sys.stdin.isatty():
+                        raise MergeConflict(
+                            f"conflict in topic '{topic}', run without --jobs to resolve it"
+                        )
+                    continue
+                heads[topic] = repo.get_commit(Oid.fromhex(oid))
+            for key, oid in new_cache_entries.items():
+                rebase_cache[key] = oid
+                rebase_cache.move_to_end(key)
+            for key, resolved in new_resolutions.items():
+                RESOLUTIONS[key] = resolved
+                RESOLUTIONS.move_to_end(key)
+    return heads
+
+def non_interactive_conflict_prompt(path, descr, *args):
+    raise MergeConflict(f"{descr} conflict for '{path}'")
 
 ON_CONFLICT = None
+# How many commits were rebased by splicing trees, and how many needed a merge.
+REBASE_STATS = {"spliced": 0, "merged": 0}
+# Whether we can ask the user to resolve conflicts.
+INTERACTIVE = True
+# Conflict resolutions of this and earlier runs.
+RESOLUTIONS: Resolutions = OrderedDict()
+
+def split_lines(body: bytes) -> List[bytes]:
+    lines = body.split(b"\n")
+    result = [line + b"\n" for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+def common_affix_lengths(base: List[bytes], side: List[bytes]) -> Tuple[int, int]:
+    """
+    Returns the number of leading and trailing lines that side shares
+    with base, without counting any line twice.
+    """
+    length = min(len(base), len(side))
+    prefix = 0
+    while prefix < length and base[prefix] == side[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < length - prefix and base[-suffix - 1] == side[-suffix - 1]:
+        suffix += 1
+    return prefix, suffix
+
+def merge_lines(current: bytes, base: bytes, other: bytes) -> Optional[bytes]:
+    """
+    Three-way merges text files in-process, if one side only changed
+    lines before, and the other side only lines after, some anchor line.
+    The anchor must occur exactly once in each file, so git-merge-file
+    cannot align the changes any other way, even with repeated lines.
+    Returns None otherwise, or if any file looks binary; those cases
+    are left to git-merge-file.
+    """
+    if any(b"\0" in body[:8000] for body in (current, base, other)):
+        return None
+    if current == base:
+        return other
+    if other == base or current == other:
+        return current
+    base_lines = split_lines(base)
+    sides = (split_lines(current), split_lines(other))
+    for first, second in (sides, sides[::-1]):
+        # Base lines from the anchor onwards are unchanged in first, and
+        # lines up to and including the anchor are unchanged in second.
+        _, first_suffix = common_affix_lengths(base_lines, first)
+        second_prefix, _ = common_affix_lengths(base_lines, second)
+        start = len(base_lines) - first_suffix
+        if start >= second_prefix:
+            continue
+        counts = [Counter(lines) for lines in (base_lines, first, second)]
+        for anchor in range(start, second_prefix):
+            if all(count[base_lines[anchor]] == 1 for count in counts):
+                unchanged = len(base_lines) - anchor
+                return b"".join(first[: len(first) - unchanged] + second[anchor:])
+    return None
 
 def override_merge_blobs(
     path: Path,
@@ -322,6 +1637,27 @@ def override_merge_blobs(
 ) -> Blob:
     repo = current.repo
 
+    # The same conflict comes up again for every topic that contains the
+    # commit, and in every run.
+    resolution_key = (
+        str(path),
+        base.oid.hex() if base else "-",
+        current.oid.hex(),
+        other.oid.hex(),
+    )
+    if resolution_key in RESOLUTIONS:
+        try:
+            resolved = repo.get_blob(Oid.fromhex(RESOLUTIONS[resolution_key]))
+        except MissingObject:
+            del RESOLUTIONS[resolution_key]
+        else:
+            RESOLUTIONS.move_to_end(resolution_key)
+            return resolved
+
+    merged = merge_lines(current.body, base.body if base else b"", other.body)
+    if merged is not None:
+        return Blob(repo, merged)
+
     tmpdir = repo.get_tempdir()
 
     annotated_labels = (
@@ -353,13 +1689,22 @@ def override_merge_blobs(
     print(f"  Path: '{path}'")
 
     preimage = merged
+    # Without rerere.autoUpdate, git-revise asks before replaying.
+    if not INTERACTIVE and not repo.bool_config("rerere.autoUpdate", default=False):
+        raise MergeConflict(f"conflict applying '{labels[2]}' to '{path}'")
     (normalized_preimage, conflict_id, merged_blob) = merge.replay_recorded_resolution(
         repo, tmpdir, preimage
     )
     if merged_blob is not None:
+        merged_blob.persist()
+        RESOLUTIONS[resolution_key] = merged_blob.oid.hex()
         return merged_blob
 
-    ON_CONFLICT(path)
+    if not INTERACTIVE:
+        raise MergeConflict(f"conflict applying '{labels[2]}' to '{path}'")
+
+    if ON_CONFLICT is not None:
+        ON_CONFLICT(path)
 
     if input("  Edit conflicted file? (Y/n) ").lower() == "n":
         raise MergeConflict("user aborted")
@@ -384,9 +1729,199 @@ def override_merge_blobs(
 
     merge.record_resolution(repo, conflict_id, normalized_preimage, merged)
 
-    return Blob(current.repo, merged)
+    merged_blob = Blob(current.repo, merged)
+    merged_blob.persist()
+    RESOLUTIONS[resolution_key] = merged_blob.oid.hex()
+    return merged_blob
+
+def pick_topic(repo, tip) -> str:
+    """
+    Returns the topic for commits picked from the given ref: the ref
+    without remote name, or with "refs/" replaced by "gitref/" to avoid
+    creating ambiguous refs.
+    """
+    if tip.startswith("refs/"):
+        return "gitref/" + tip[len("refs/") :]
+    remote, _, branch = tip.partition("/")
+    if branch and remote in repo.git("remote").decode().splitlines():
+        return branch
+    return tip
+
+def log_topics(repo, prefix_prefix, prefix_suffix, *args) -> List[Tuple[str, Optional[str]]]:
+    """
+    Returns the commits listed by "git log <args>", with their topics.
+    Unlike iter_log(), this includes commits with an empty subject.
+    """
+    commits = []
+    for entry in read_log(repo, "--format=%H %s", *args):
+        parsed = parse_subject(prefix_prefix, prefix_suffix, entry)
+        commits.append((entry.split(maxsplit=1)[0], parsed[1] if parsed else None))
+    return commits
+
+def upstream_commits(repo) -> List[str]:
+    """
+    Returns the commits in @{upstream} that are not in HEAD, if the current
+    branch has an upstream.
+    """
+    upstream = upstream_ref(repo)
+    if upstream is None:
+        return []
+    return list(read_log(repo, "--format=%H", "--no-merges", f"HEAD..{upstream}"))
+
+def pick(
+    repo, revision_ranges, patch_id_cache: PatchIdCache
+) -> Tuple[Commit, int, int, int]:
+    """
+    Replaces the commits of each topic named after the tip of one of the
+    given ranges by the commits in that range, with subjects prefixed by
+    the topic tag. Like "git rebase -i", picked commits are inserted after
+    the first run of dropped commits of their topic, or at the end.
+    Commits whose patch is already in HEAD or in its upstream are skipped.
+    HEAD is updated once at the end; only files that differ between the
+    old and new HEAD are updated in the worktree.
+
+    Returns the new HEAD, and the number of picked, skipped and dropped
+    commits.
+    """
+    prefix_prefix, prefix_suffix = read_affixes(repo)
+    old_head = repo.get_commit("HEAD")
+    cherries: Dict[str, List[str]] = OrderedDict()
+    bases = []
+    for revision_range in revision_ranges:
+        base, tip = revision_range.split("..", 1)
+        bases.append(base or tip)
+        cherries.setdefault(pick_topic(repo, tip), []).extend(
+            commit
+            for commit, _ in log_topics(
+                repo, prefix_prefix, prefix_suffix, "--reverse", "--no-merges", revision_range
+            )
+        )
+    if not any(cherries.values()):
+        return old_head, 0, 0, 0
+    onto = repo.git("merge-base", "--octopus", "HEAD", *bases).decode()
+    commits = log_topics(
+        repo, prefix_prefix, prefix_suffix, "--reverse", "--no-merges", f"{onto}..HEAD"
+    )
+    kept = [commit for commit, topic in commits if topic not in cherries]
+    upstream = upstream_commits(repo)
+    all_cherries = [commit for topic_cherries in cherries.values() for commit in topic_cherries]
+    ids = patch_ids(repo, kept + upstream + all_cherries, patch_id_cache)
+    known = {ids[commit] for commit in kept + upstream}
+    skipped = 0
+    for topic, topic_cherries in cherries.items():
+        new_cherries = []
+        for commit in topic_cherries:
+            patch_id = ids[commit]
+            if patch_id is not None and patch_id in known:
+                skipped += 1
+                continue
+            known.add(patch_id)
+            new_cherries.append(commit)
+        cherries[topic] = new_cherries
+
+    tags = {topic: f"{prefix_prefix}{topic}{prefix_suffix} ".encode() for topic in cherries}
+    todo: List[Tuple[str, Optional[bytes]]] = []
+    dropped = 0
+    # Topics whose cherries go before the next commit we keep.
+    pending: List[str] = []
+    for commit, topic in commits:
+        if topic in tags:
+            dropped += 1
+            if topic in cherries and topic not in pending:
+                pending.append(topic)
+            continue
+        for t in pending:
+            todo += [(cherry, tags[t]) for cherry in cherries.pop(t)]
+        pending = []
+        todo.append((commit, None))
+    for topic, topic_cherries in cherries.items():
+        todo += [(cherry, tags[topic]) for cherry in topic_cherries]
+
+    global ON_CONFLICT
+    ON_CONFLICT = None
+    resolutions = use_resolutions(repo)
+    head = repo.get_commit(onto)
+    picked = 0
+    try:
+        for commit, tag in todo:
+            patch = repo.get_commit(commit)
+            tree = rebased_tree(patch, head)
+            if tag is not None:
+                picked += 1
+                head = repo.new_commit(
+                    tree=tree, parents=[head], message=tag + patch.message, author=patch.author
+                )
+            else:
+                head = patch.update(tree=tree, parents=[head])
+    finally:
+        if RESOLUTIONS != resolutions:
+            save_resolutions(repo, RESOLUTIONS)
+    if head != old_head:
+        head.persist()
+        # Like "git checkout", refuse to overwrite local changes.
+        repo.git("read-tree", "-m", "-u", old_head.tree().oid.hex(), head.tree().oid.hex())
+        repo.git(
+            "update-ref",
+            "-m",
+            f"git-branchstack pick {' '.join(revision_ranges)}",
+            "HEAD",
+            head.oid.hex(),
+            old_head.oid.hex(),
+        )
+    return head, picked, skipped, dropped
+
+def print_predictions(conflicts, report_format):
+    if report_format == "json":
+        predictions = {
+            topic: {"clean": not paths, "paths": paths}
+            for topic, paths in conflicts.items()
+        }
+        json.dump({"topics": predictions}, sys.stdout, indent=2)
+        print()
+        return
+    for topic, paths in conflicts.items():
+        if paths:
+            print(f"{topic}: may conflict ({', '.join(paths)})")
+        else:
+            print(f"{topic}: clean")
+
+def dot_quote(s: str) -> str:
+    """
+    Quotes a string for Graphviz' DOT language. Unlike JSON, DOT takes
+    non-ASCII characters as they are.
+    """
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def print_graph(graph, graph_format):
+    if graph_format == "json":
+        json.dump(graph, sys.stdout, indent=2)
+        print()
+        return
+    # Edges point from topics to their dependencies. Dependencies whose
+    # topic tag is kept are dashed.
+    print("digraph branchstack {")
+    for topic, info in graph["topics"].items():
+        label = f"{topic} ({len(info['commits'])})"
+        print(f"\t{dot_quote(topic)} [label={dot_quote(label)}];")
+    for topic, info in graph["topics"].items():
+        for dependency in info["dependencies"]:
+            style = " [style=dashed]" if dependency["keep_tag"] else ""
+            print(f"\t{dot_quote(topic)} -> {dot_quote(dependency['topic'])}{style};")
+    print("}")
 
-gitrevise.merge.merge_blobs = override_merge_blobs
+def print_branch_list(branch_list, list_format):
+    if list_format == "json":
+        json.dump({"topics": branch_list}, sys.stdout, indent=2)
+        print()
+        return
+    width = max((len(info["topic"]) for info in branch_list), default=0)
+    for info in branch_list:
+        line = f"{info['topic'].ljust(width)} {info['status'].ljust(10)} {info['commits']} commit"
+        if info["commits"] != 1:
+            line += "s"
+        if info["dependencies"]:
+            line += f", depends on {', '.join(info['dependencies'])}"
+        print(line)
 
 def dwim(repo: Repository) -> Tuple[str, str]:
     rebase_dir = repo.gitdir / "rebase-merge"
@@ -436,6 +1971,156 @@ def parser() -> argparse.ArgumentParser:
         help="use commits from the given range instead of @{upstream}..",
     )
 
+    p.add_argument(
+        "--jobs",
+        "-j",
+        metavar="<n>",
+        type=int,
+        default=1,
+        help="build independent topics in up to <n> parallel processes",
+    )
+
+    p.add_argument(
+        "--pack",
+        action="store_true",
+        help="write new objects into a single pack instead of loose objects",
+    )
+
+    p.add_argument(
+        "--skip-upstreamed",
+        action="store_true",
+        help="skip commits whose patch is already in @{upstream} (or the start of --range)",
+    )
+
+    p.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, and update branches whenever HEAD or its upstream change",
+    )
+
+    p.add_argument(
+        "--check-deps",
+        action="store_true",
+        help="only report likely missing dependencies, without creating branches",
+    )
+
+    p.add_argument(
+        "--predict",
+        action="store_true",
+        help="only report which topics may have conflicts, without creating branches",
+    )
+
+    p.add_argument(
+        "--profile",
+        action="store_true",
+        help="print where time was spent",
+    )
+
+    p.add_argument(
+        "--profile-trace",
+        metavar="<file>",
+        help="like --profile, and write a trace to <file> (in Chrome's trace event format)",
+    )
+
+    p.add_argument(
+        "--format",
+        choices=("text", "json"),
+        default="text",
+        help="print created branches in the given format",
+    )
+
+    return p
+
+def graph_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        prog="git branchstack graph",
+        description="Print the topics in @{upstream}..HEAD and the dependencies between them.",
+    )
+
+    p.add_argument(
+        "<topic>",
+        nargs="*",
+        help="only print the given topics and their dependencies",
+    )
+
+    p.add_argument(
+        "--range",
+        "-r",
+        metavar="<rev1>..<rev2>",
+        help="use commits from the given range instead of @{upstream}..",
+    )
+
+    p.add_argument(
+        "--format",
+        choices=("json", "dot"),
+        default="json",
+        help="print the graph as JSON or in Graphviz' DOT language",
+    )
+
+    return p
+
+def pick_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        prog="git branchstack pick",
+        description="""\
+Cherry-pick the commits in each <base>..<commit>, prefixing their subjects
+with "[<topic>] ", and drop older commits with that topic from HEAD.
+<topic> is <commit>, without the remote name if it starts with one.
+Commits whose patch is already in HEAD or its upstream are skipped.
+Unlike git-branchstack-pick, this does not run an interactive rebase and
+only updates files in the worktree that change.""",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    p.add_argument(
+        "ranges",
+        nargs="+",
+        metavar="<base>..<commit>",
+        help="the commits to pick; <base> defaults to <commit>",
+    )
+
+    return p
+
+def list_branches_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        prog="git branchstack list-branches",
+        description="List the topics in @{upstream}..HEAD, and whether their branches are up-to-date.",
+    )
+
+    p.add_argument(
+        "<topic>",
+        nargs="*",
+        help="only list the given topics",
+    )
+
+    p.add_argument(
+        "--range",
+        "-r",
+        metavar="<rev1>..<rev2>",
+        help="use commits from the given range instead of @{upstream}..",
+    )
+
+    p.add_argument(
+        "--keep-tags",
+        nargs="?",
+        const="dependencies",
+        choices=("dependencies", "all"),
+        help="compare against branches created with this --keep-tags setting",
+    )
+
+    p.add_argument(
+        "--skip-upstreamed",
+        action="store_true",
+        help="compare against branches created with --skip-upstreamed",
+    )
+
+    p.add_argument(
+        "--format",
+        choices=("text", "json"),
+        default="text",
+        help="print the list in a human-readable or machine-readable format",
+    )
+
     return p
 
 def parse_range(repo: Repository, range: str) -> Tuple[str, str]:
@@ -445,56 +2130,293 @@ def parse_range(repo: Repository, range: str) -> Tuple[str, str]:
     assert lower.startswith("^")
     return lower[len("^") :], upper
 
-def main(argv: Optional[List[str]] = None):
-    args = parser().parse_args(argv)
+def upstream_revision(repo, args) -> str:
+    """
+    Returns the upstream that --skip-upstreamed compares against.
+    """
+    if args.range is None:
+        return dwim(repo)[1]
+    return parse_range(repo, args.range)[0]
+
+def resolve_range(repo, args) -> Tuple[Optional[str], str, str]:
+    """
+    Returns the current branch, the base commit and the tip of the range
+    of commits to create branches from.
+    """
+    with phase("resolve range"):
+        if args.range is None:
+            branch, base_commit = dwim(repo)
+            tip = "HEAD"
+        else:
+            branch = None
+            base_commit, tip = parse_range(repo, args.range)
+        base_commit = repo.git("merge-base", "--", base_commit, "HEAD").decode()
+    return branch, base_commit, tip
+
+def upstream_ref(repo) -> Optional[str]:
+    """
+    Returns the full name of the upstream of the current branch, or None
+    if there is none.  Unlike "@{upstream}", this does not print errors.
+    """
+    try:
+        branch = repo.git("symbolic-ref", "-q", "HEAD").decode()
+    except CalledProcessError:
+        return None  # detached HEAD
+    upstream = repo.git("for-each-ref", "--format=%(upstream)", "--", branch).decode()
+    return upstream or None
+
+def watched_paths(repo) -> List[Path]:
+    """
+    Returns the files that change when HEAD, the current branch or its
+    upstream are updated, or when a rebase starts or stops.
+    """
+    names = ["HEAD", "logs/HEAD", "packed-refs", "FETCH_HEAD", "rebase-merge"]
+    try:
+        names.append(repo.git("symbolic-ref", "-q", "HEAD").decode())
+    except CalledProcessError:
+        pass  # detached HEAD
+    upstream = upstream_ref(repo)
+    if upstream is not None:
+        names.append(upstream)
+    return [repo.git_path(name) for name in names]
+
+def file_state(paths) -> List[Optional[Tuple[int, int, int]]]:
+    state = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            state.append(None)
+            continue
+        state.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return state
+
+def watch(repo, rebuild) -> None:
+    """
+    Calls rebuild whenever the watched files change, until interrupted.
+    The standard library has no portable file change notification, so
+    we poll their modification times.
+    """
+    global INTERACTIVE
+    INTERACTIVE = False
+    merge.conflict_prompt = non_interactive_conflict_prompt
+    paths = watched_paths(repo)
+    state = None
+    try:
+        while True:
+            new_state = file_state(paths)
+            if new_state == state:
+                time.sleep(WATCH_INTERVAL)
+                continue
+            # Wait until Git is done, for example with all steps of a rebase.
+            time.sleep(WATCH_DEBOUNCE)
+            if file_state(paths) != new_state:
+                continue
+            state = new_state
+            try:
+                rebuild()
+            except USER_ERRORS as err:
+                print(error_message(err))
+            new_paths = watched_paths(repo)
+            if new_paths != paths:
+                paths = new_paths
+                state = file_state(paths)
+    except KeyboardInterrupt:
+        pass
+
+USER_ERRORS = (
+    BranchWasModifiedError,
+    CalledProcessError,
+    DependencyCycleError,
+    EditorError,
+    InvalidRangeError,
+    MergeConflict,
+    TopicNotFoundError,
+    ValueError,
+)
+
+def error_message(err) -> str:
+    if isinstance(err, BranchWasModifiedError):
+        return f"error: generated branch {err} has been modified. Use --force to overwrite."
+    if isinstance(err, CalledProcessError):
+        return f"subprocess exited with non-zero status: {err.returncode}"
+    if isinstance(err, DependencyCycleError):
+        (cycle,) = err.args
+        return f"error: topics depend on each other: {' -> '.join(cycle)}"
+    if isinstance(err, EditorError):
+        return f"editor error: {err}"
+    if isinstance(err, InvalidRangeError):
+        return f'invalid commit range: {err} should be a valid "a..b" range'
+    if isinstance(err, MergeConflict):
+        return f"merge conflict: {err}"
+    if isinstance(err, TopicNotFoundError):
+        topic, base_commit, tip = err.args
+        return f"error: topic '{topic}' not found {base_commit}..{tip}"
+    return f"invalid value: {err}"
+
+def graph_main(argv: List[str]):
+    args = graph_parser().parse_args(argv)
     try:
+        if args.range is not None and ".." not in args.range:
+            raise InvalidRangeError(args.range)
         with Repository() as repo:
-            if args.range is None:
-                branch, base_commit = dwim(repo)
-                tip = "HEAD"
-            else:
-                branch = None
-                base_commit, tip = parse_range(repo, args.range)
-            if args.keep_tags is not None:
-                if args.keep_tags not in ("dependencies", "all"):
-                    print(
-                        "argument to --keep-tags must be one of 'dependencies' (the default) or 'all'"
-                    )
-                    sys.exit(1)
-            base_commit = repo.git("merge-base", "--", base_commit, "HEAD").decode()
-            create_branches(
+            _, base_commit, tip = resolve_range(repo, args)
+            graph = topic_graph(repo, base_commit, tip, getattr(args, "<topic>"))
+        print_graph(graph, args.format)
+    except USER_ERRORS as err:
+        print(error_message(err))
+        sys.exit(1)
+
+def list_branches_main(argv: List[str]):
+    args = list_branches_parser().parse_args(argv)
+    try:
+        if args.range is not None and ".." not in args.range:
+            raise InvalidRangeError(args.range)
+        with Repository() as repo:
+            _, base_commit, tip = resolve_range(repo, args)
+            upstream = upstream_revision(repo, args) if args.skip_upstreamed else None
+            branch_list = list_branches(
                 repo,
-                branch,
                 base_commit,
                 tip,
                 getattr(args, "<topic>"),
-                force=args.force,
-                keep_tags=args.keep_tags,
+                args.keep_tags,
+                upstream,
             )
-    except BranchWasModifiedError as err:
+        print_branch_list(branch_list, args.format)
+    except USER_ERRORS as err:
+        print(error_message(err))
+        sys.exit(1)
+
+def pick_main(argv: List[str]):
+    args = pick_parser().parse_args(argv)
+    try:
+        for revision_range in args.ranges:
+            if ".." not in revision_range:
+                raise InvalidRangeError(revision_range)
+        with Repository() as repo:
+            patch_id_cache = load_patch_id_cache(repo)
+            try:
+                head, picked, skipped, dropped = pick(repo, args.ranges, patch_id_cache)
+            finally:
+                # Keep the patch IDs even if a conflict stops us.
+                save_patch_id_cache(repo, patch_id_cache)
+        if not picked and not skipped:
+            print(f"nothing to cherry-pick from {' '.join(args.ranges)}")
+            return
         print(
-            f"error: generated branch {err} has been modified. Use --force to overwrite."
+            f"picked {picked}, skipped {skipped} and dropped {dropped} commits, HEAD is now {head.oid.short()}"
         )
+    except USER_ERRORS as err:
+        print(error_message(err))
         sys.exit(1)
-    except CalledProcessError as err:
-        print(f"subprocess exited with non-zero status: {err.returncode}")
-        sys.exit(1)
-    except EditorError as err:
-        print(f"editor error: {err}")
-        sys.exit(1)
-    except InvalidRangeError as err:
-        print(f'invalid commit range: {err} should be a valid "a..b" range')
-        sys.exit(1)
-    except MergeConflict as err:
-        print(f"merge conflict: {err}")
-        sys.exit(1)
-    except TopicNotFoundError as err:
-        topic, base_commit, tip = err.args
-        print(f"error: topic '{topic}' not found {base_commit}..{tip}")
-        sys.exit(1)
-    except ValueError as err:
-        print(f"invalid value: {err}")
+
+def main(argv: Optional[List[str]] = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # Use "git branchstack -- graph" to create a branch named "graph".
+    if argv[:1] == ["graph"]:
+        graph_main(argv[1:])
+        return
+    if argv[:1] == ["pick"]:
+        pick_main(argv[1:])
+        return
+    if argv[:1] == ["list-branches"]:
+        list_branches_main(argv[1:])
+        return
+    args = parser().parse_args(argv)
+    profile = os.environ.get("GIT_BRANCHSTACK_PROFILE")
+    if args.profile_trace is None and profile:
+        args.profile_trace = profile
+    if profile is not None or args.profile_trace is not None:
+        args.profile = True
+    if args.keep_tags is not None:
+        if args.keep_tags not in ("dependencies", "all"):
+            print(
+                "argument to --keep-tags must be one of 'dependencies' (the default) or 'all'"
+            )
+            sys.exit(1)
+    profiler = enable_profiling() if args.profile else None
+    try:
+        # Fail early, before starting any git processes.
+        if args.range is not None and ".." not in args.range:
+            raise InvalidRangeError(args.range)
+        with Repository() as repo:
+            branch, base_commit, tip = resolve_range(repo, args)
+            if args.check_deps:
+                missing = check_dependencies(
+                    repo, base_commit, tip, getattr(args, "<topic>")
+                )
+                for topic, missing_deps in missing.items():
+                    for dependency, paths in missing_deps.items():
+                        print(
+                            f"topic '{topic}' likely depends on '{dependency}' ({', '.join(paths)})"
+                        )
+                sys.exit(1 if missing else 0)
+            if args.predict:
+                conflicts = predict_conflicts(
+                    repo, base_commit, tip, getattr(args, "<topic>")
+                )
+                print_predictions(conflicts, args.format)
+                return
+            pack = args.pack or repo.bool_config(
+                "branchstack.packObjects", default=False
+            )
+            if args.watch:
+                # Rebased commits stay valid, so keep them across rebuilds.
+                rebase_memo: RebaseMemo = {}
+                def rebuild():
+                    branch, base_commit, tip = resolve_range(repo, args)
+                    upstream = (
+                        upstream_revision(repo, args) if args.skip_upstreamed else None
+                    )
+                    with redirect_stdout(
+                        sys.stderr if args.format == "json" else sys.stdout
+                    ):
+                        report = create_branches(
+                            repo,
+                            branch,
+                            base_commit,
+                            tip,
+                            getattr(args, "<topic>"),
+                            force=args.force,
+                            keep_tags=args.keep_tags,
+                            jobs=args.jobs,
+                            pack=pack,
+                            rebase_memo=rebase_memo,
+                            upstream=upstream,
+                        )
+                    while len(rebase_memo) > REBASE_CACHE_SIZE:
+                        del rebase_memo[next(iter(rebase_memo))]
+                    print_report(report, args.format, REBASE_STATS)
+                watch(repo, rebuild)
+                return
+            upstream = upstream_revision(repo, args) if args.skip_upstreamed else None
+            # Keep stdout clean for machine-readable output.
+            with redirect_stdout(sys.stderr if args.format == "json" else sys.stdout):
+                report = create_branches(
+                    repo,
+                    branch,
+                    base_commit,
+                    tip,
+                    getattr(args, "<topic>"),
+                    force=args.force,
+                    keep_tags=args.keep_tags,
+                    jobs=args.jobs,
+                    pack=pack,
+                    upstream=upstream,
+                )
+            with phase("summary"):
+                print_report(report, args.format, REBASE_STATS)
+    except USER_ERRORS as err:
+        print(error_message(err))
         sys.exit(1)
+    finally:
+        if profiler is not None:
+            disable_profiling()
+            profiler.print_table(sys.stderr)
+            if args.profile_trace:
+                profiler.write_trace(args.profile_trace)
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,12 @@
 #!/usr/bin/env pytest
 
 from subprocess import Popen
-from gitrevise.odb import Repository
+from gitrevise import merge
+from gitrevise.odb import Blob, Oid, Repository
 from pathlib import Path
 import pytest
+import json
+import random
 import textwrap
 import gitbranchstack.main as gitbranchstack
 
@@ -169,6 +172,720 @@ def test_create_branches_keep_tags_in_prefixed_parents(repo) -> None:
         == "subject a\n" + "[b] subject b"
     )
 
+def test_create_branches_rebase_shared_dependencies_once(repo, monkeypatch) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[b] subject b")
+    repo.git("commit", "--allow-empty", "-m", "[a:b] subject a")
+    repo.git("commit", "--allow-empty", "-m", "[c:b] subject c")
+
+    rebased = []
+    rebased_tree = gitbranchstack.rebased_tree
+    def counting_rebased_tree(commit, new_parent):
+        rebased.append(commit.summary())
+        return rebased_tree(commit, new_parent)
+    monkeypatch.setattr(gitbranchstack, "rebased_tree", counting_rebased_tree)
+
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+    assert sorted(rebased) == [
+        "[a:b] subject a",
+        "[b] subject b",
+        "[c:b] subject c",
+    ]
+    for topic in ("a", "c"):
+        assert repo.git("rev-parse", f"{topic}~").decode() == repo.git(
+            "rev-parse", "b"
+        ).decode()
+
+def test_create_branches_reuse_rebased_commits_across_runs(repo, monkeypatch) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[a] a1")
+    repo.git("commit", "--allow-empty", "-m", "[a] a2")
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+    a = repo.git("rev-parse", "a").decode()
+
+    rebased = []
+    rebased_tree = gitbranchstack.rebased_tree
+    def counting_rebased_tree(commit, new_parent):
+        rebased.append(commit.summary())
+        return rebased_tree(commit, new_parent)
+    monkeypatch.setattr(gitbranchstack, "rebased_tree", counting_rebased_tree)
+
+    with Repository() as fresh_repo:
+        gitbranchstack.create_branches(fresh_repo, None, INITIAL_COMMIT, "HEAD")
+    assert rebased == []
+    assert repo.git("rev-parse", "a").decode() == a
+
+    repo.git("commit", "--amend", "--allow-empty", "-m", "[a] a2 amended")
+    with Repository() as fresh_repo:
+        gitbranchstack.create_branches(fresh_repo, None, INITIAL_COMMIT, "HEAD")
+    assert rebased == ["[a] a2 amended"]
+
+def test_create_branches_skip_unchanged_topics(repo, monkeypatch) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[a] subject a")
+    repo.git("commit", "--allow-empty", "-m", "[b] subject b")
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+
+    created = []
+    build_topic = gitbranchstack.build_topic
+    def recording_build_topic(*args):
+        created.append(args[7])
+        return build_topic(*args)
+    monkeypatch.setattr(gitbranchstack, "build_topic", recording_build_topic)
+
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+    assert created == []
+
+    repo.git("commit", "--allow-empty", "-m", "[b] subject b2")
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+    assert created == ["b"]
+
+    gitbranchstack.create_branches(
+        repo, None, INITIAL_COMMIT, "HEAD", keep_tags="all"
+    )
+    assert created == ["b", "a", "b"]
+
+def test_create_branches_parallel(repo) -> None:
+    repo.git("add", write("a", "a1"))
+    repo.git("commit", "-m", "[a] a1")
+    repo.git("add", write("b", "b1"))
+    repo.git("commit", "-m", "[b] b1")
+    repo.git("add", write("c", "c1"))
+    repo.git("commit", "-m", "[c:a] c1")
+
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+    expected = {t: repo.git("rev-parse", t).decode() for t in ("a", "b", "c")}
+    repo.git("branch", "-D", "a", "b", "c")
+    (repo.gitdir / "branchstack-cache").unlink()
+    (repo.gitdir / "branchstack-rebase-cache").unlink()
+
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD", jobs=2)
+    assert {t: repo.git("rev-parse", t).decode() for t in expected} == expected
+
+def test_create_branches_parallel_conflict(repo) -> None:
+    repo.git("add", write("a", "a1"))
+    repo.git("commit", "-m", "[a] a1")
+    repo.git("add", write("a", "a2"))
+    repo.git("commit", "-m", "[b] a2")
+
+    try:
+        gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD", jobs=2)
+        assert False, "Expect error about conflict in non-interactive mode"
+    except gitbranchstack.MergeConflict as e:
+        assert "topic 'b'" in str(e)
+    assert not repo.git("branch", "--list", "a", "b")
+
+def test_create_branches_parallel_rerere(repo, monkeypatch) -> None:
+    repo.git("config", "rerere.enabled", "true")
+    repo.git("config", "rerere.autoUpdate", "true")
+    repo.git("add", write("a", "1\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("add", write("a", "a1\n"))
+    repo.git("commit", "-m", "[a] a1")
+    repo.git("add", write("a", "a2\n"))
+    repo.git("commit", "-m", "[b] a2")
+
+    monkeypatch.setattr(gitbranchstack.utils, "edit_file", lambda repo, path: b"b\n")
+    monkeypatch.setattr("builtins.input", lambda prompt: "y")
+    gitbranchstack.create_branches(repo, None, "HEAD~2", "HEAD", branches=("b",))
+
+    # Workers cannot prompt, but they can replay the recorded resolution.
+    for cache in ("branchstack-cache", "branchstack-rebase-cache", "branchstack-resolutions"):
+        (repo.gitdir / cache).unlink()
+    repo.git("branch", "-D", "b")
+    monkeypatch.setattr("builtins.input", None)
+    gitbranchstack.create_branches(repo, None, "HEAD~2", "HEAD", jobs=2)
+    assert repo.git("show", "b:a").decode() == "b"
+    # The parent saves the resolution that a worker replayed.
+    resolutions = gitbranchstack.load_resolutions(repo)
+    assert [repo.get_blob(Oid.fromhex(oid)).body for oid in resolutions.values()] == [
+        b"b\n"
+    ]
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_create_branches_pack(repo, jobs) -> None:
+    Path("d").mkdir()
+    repo.git("add", write("d/f", "1\n2\n3\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("add", write("d/f", "a\n2\n3\n"))
+    repo.git("commit", "-m", "[a] a1")
+    repo.git("add", write("d/f", "a\n2\nb\n"))
+    repo.git("commit", "-m", "[b] b1")
+    repo.git("add", write("g", "g\n"))
+    repo.git("commit", "-m", "[c:b] c1")
+    loose_objects = set((repo.gitdir / "objects").glob("??/*"))
+
+    gitbranchstack.create_branches(
+        repo, None, "HEAD~3", "HEAD", jobs=jobs, pack=True
+    )
+    assert set((repo.gitdir / "objects").glob("??/*")) == loose_objects
+    assert len(list((repo.gitdir / "objects/pack").glob("*.pack"))) == jobs
+    assert repo.git("show", "b:d/f").decode() == "1\n2\nb"
+    assert repo.git("show", "c:g").decode() == "g"
+    repo.git("fsck", "--strict")
+
+def test_main_skip_upstreamed(repo, capsys) -> None:
+    repo.git("checkout", "-q", "-b", "upstream")
+    repo.git("add", write("f", "f\n"))
+    repo.git("commit", "-m", "applied with a different message")
+    repo.git("add", write("h", "h\n"))
+    repo.git("commit", "-m", "also applied")
+    repo.git("checkout", "-q", "🐬")
+    repo.git("add", write("f", "f\n"))
+    repo.git("commit", "-m", "[a] a1")
+    repo.git("add", write("g", "g\n"))
+    repo.git("commit", "-m", "[a] a2")
+    repo.git("add", write("h", "h\n"))
+    repo.git("commit", "-m", "[b] b1")
+
+    gitbranchstack.main(["--range", "upstream..HEAD", "--skip-upstreamed"])
+    out = capsys.readouterr().out
+    assert "Skipping topic 'b', all of its commits are upstream." in out
+    expected = """\
+*  (HEAD -> 🐬) [b] b1
+*  [a] a2
+*  [a] a1
+| *  (a) a2
+| *  (upstream) also applied
+| *  applied with a different message
+|/
+*  本"""
+    assert expected == graph(repo, "a")
+    assert "b" not in gitbranchstack.read_branches(repo, ["b"])
+    assert len(gitbranchstack.load_patch_id_cache(repo)) == 5
+
+def test_main_skip_upstreamed_later_commit(repo, capsys) -> None:
+    repo.git("add", write("f", "2\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("checkout", "-q", "-b", "upstream")
+    repo.git("add", write("f", "2a\n"))
+    repo.git("commit", "-m", "applied")
+    repo.git("checkout", "-q", "🐬")
+    repo.git("add", write("f", "2a\n"))
+    repo.git("commit", "-m", "[a] a1")
+    repo.git("add", write("f", "2b\n"))
+    repo.git("commit", "-m", "[a] a2")
+
+    # a2 only applies on top of the upstream version of a1.
+    gitbranchstack.main(["--range", "upstream..HEAD", "--skip-upstreamed"])
+    assert repo.git("show", "a:f").decode() == "2b"
+    assert repo.git("rev-parse", "a~") == repo.git("rev-parse", "upstream")
+
+    capsys.readouterr()
+    list_branches = ["list-branches", "--range", "upstream..HEAD"]
+    gitbranchstack.main(list_branches + ["--skip-upstreamed"])
+    assert capsys.readouterr().out == "a up-to-date 1 commit\n"
+    gitbranchstack.main(list_branches)
+    assert capsys.readouterr().out == "a stale      2 commits\n"
+
+def test_create_branches_update_all_or_nothing(repo, monkeypatch) -> None:
+    repo.git("add", write("a", "a1"))
+    repo.git("commit", "-m", "[a] a1")
+    repo.git("add", write("a", "a2"))
+    repo.git("commit", "-m", "[b] a2")
+
+    monkeypatch.setattr("builtins.input", lambda prompt: "a")
+    try:
+        gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+        assert False, "Expect error about aborted conflict resolution"
+    except gitbranchstack.MergeConflict:
+        pass
+    assert not repo.git("branch", "--list", "a", "b")
+
+def test_update_branches_concurrent_modification(repo) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[a] subject a")
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+    existing_branches = gitbranchstack.read_branches(repo, ("a",))
+    assert existing_branches == {"a": repo.git("rev-parse", "a").decode()}
+
+    repo.git("update-ref", "refs/heads/a", "HEAD~")
+    head = repo.get_commit("HEAD")
+    try:
+        gitbranchstack.update_branches(repo, existing_branches, {"a": head})
+        assert False, "Expect update-ref to fail"
+    except gitbranchstack.CalledProcessError:
+        pass
+    assert repo.git("rev-parse", "a") == repo.git("rev-parse", "HEAD~")
+
+def test_main_report(repo, capsys) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[a] a1")
+    repo.git("commit", "--allow-empty", "-m", "[b] b1")
+    repo.git("commit", "--allow-empty", "-m", "[a] a2")
+    gitbranchstack.create_branches(repo, None, INITIAL_COMMIT, "HEAD")
+    capsys.readouterr()
+
+    gitbranchstack.main(["--range", f"{INITIAL_COMMIT}..HEAD"])
+    log = lambda topic: repo.git("log", "--format=%h %s", f"{INITIAL_COMMIT}..{topic}")
+    expected = "".join(
+        f"{topic}\n" + "".join(f"\t {line}\n" for line in log(topic).decode().splitlines())
+        for topic in ("a", "b")
+    )
+    assert capsys.readouterr().out == expected
+
+    gitbranchstack.main(["--range", f"{INITIAL_COMMIT}..HEAD", "--format=json"])
+    report = json.loads(capsys.readouterr().out)
+    assert report == {
+        "topics": [
+            {
+                "topic": "a",
+                "head": repo.git("rev-parse", "a").decode(),
+                "updated": False,
+                "commits": [
+                    {"commit": repo.git("rev-parse", "a").decode(), "subject": "a2"},
+                    {"commit": repo.git("rev-parse", "a~").decode(), "subject": "a1"},
+                ],
+            },
+            {
+                "topic": "b",
+                "head": repo.git("rev-parse", "b").decode(),
+                "updated": False,
+                "commits": [
+                    {"commit": repo.git("rev-parse", "b").decode(), "subject": "b1"},
+                ],
+            },
+        ],
+        "rebase": {"spliced": 0, "merged": 0},
+    }
+
+def test_create_branches_splice_trees(repo) -> None:
+    Path("d").mkdir()
+    repo.git("add", write("d/x", "x\n"), write("d/y", "1\n2\n3\n4\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("add", write("d/x", "a\n"))
+    repo.git("commit", "-m", "[a] change d/x")
+    repo.git("add", write("d/y", "1\n2\n3\nb\n"))
+    repo.git("commit", "-m", "[b] change d/y")
+    repo.git("add", write("d/y", "c\n2\n3\nb\n"))
+    repo.git("commit", "-m", "[c:a] change d/y again")
+
+    gitbranchstack.create_branches(repo, None, "HEAD~3", "HEAD")
+    assert gitbranchstack.REBASE_STATS == {"spliced": 2, "merged": 1}
+    assert repo.git("show", "b:d/x").decode() == "x"
+    assert repo.git("show", "c:d/x").decode() == "a"
+    assert repo.git("show", "c:d/y").decode() == "c\n2\n3\n4"
+
+def test_main_profile(repo, capsys, monkeypatch) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[a] a1")
+    monkeypatch.setenv("GIT_BRANCHSTACK_PROFILE", "trace.json")
+
+    gitbranchstack.main(["--range", f"{INITIAL_COMMIT}..HEAD"])
+    table = capsys.readouterr().err
+    assert table.startswith("phase ")
+    phases = ("parse_log", "build_topic", "rebase", "update refs", "topic report")
+    for phase in phases + ("summary", "git log"):
+        assert f"\n{phase} " in table
+    with open("trace.json") as f:
+        events = json.load(f)["traceEvents"]
+    assert {"name", "cat", "ph", "ts", "dur", "pid", "tid"} <= set(events[0])
+    assert ("build_topic", "a") in [
+        (event["name"], event.get("args", {}).get("detail")) for event in events
+    ]
+    assert gitbranchstack.PROFILER is None
+
+    # A topic after --profile is not taken as the trace file.
+    monkeypatch.delenv("GIT_BRANCHSTACK_PROFILE")
+    repo.git("commit", "--allow-empty", "-m", "[b] b1")
+    gitbranchstack.main(["--range", f"{INITIAL_COMMIT}..HEAD", "--profile", "b"])
+    captured = capsys.readouterr()
+    assert captured.out.endswith("\nb\n\t 5a0f40b b1\n")
+    assert captured.err.startswith("phase ")
+    assert not Path("b").exists()
+
+def test_prefetch_topics(repo) -> None:
+    repo.git("add", write("f", "1\n"))
+    repo.git("commit", "-m", "[a] a1")
+    repo.git("add", write("f", "2\n"))
+    repo.git("commit", "-m", "[b] b1")
+
+    with Repository() as fresh_repo:
+        commit_entries, dependency_graph = gitbranchstack.parse_log(
+            fresh_repo, "[", "]", f"{INITIAL_COMMIT}..HEAD", "--reverse"
+        )
+        commits_by_topic = gitbranchstack.group_by_topic(commit_entries)
+        base_commit_id = fresh_repo.git("rev-parse", INITIAL_COMMIT).decode()
+        gitbranchstack.prefetch_topics(
+            fresh_repo,
+            base_commit_id,
+            commits_by_topic,
+            gitbranchstack.dependency_closures(dependency_graph),
+            ["a"],
+        )
+        a1 = Oid.fromhex(commits_by_topic["a"][0][0])
+        b1 = Oid.fromhex(commits_by_topic["b"][0][0])
+        cached = fresh_repo._objects
+        assert a1 in cached[a1[0]]
+        assert b1 not in cached[b1[0]]
+        tree = cached[a1[0]][a1].tree_oid
+        assert tree in cached[tree[0]]
+        assert cached[tree[0]][tree].persisted
+        assert gitbranchstack.prefetch_objects(fresh_repo, [a1, tree]) == []
+
+def test_trim_object_cache(repo) -> None:
+    repo.git("add", write("f", "1\n"))
+    repo.git("commit", "-m", "add f")
+    persisted = repo.get_commit("HEAD").tree()
+    unpersisted = Blob(repo, b"new blob")
+    gitbranchstack.trim_object_cache(repo, limit=1000)
+    assert persisted.oid in repo._objects[persisted.oid[0]]
+    size = len(persisted.body) + len(unpersisted.body)
+    assert gitbranchstack.OBJECT_CACHE_USAGE.size == size
+    # Only new objects are counted.
+    new = Blob(repo, b"another blob")
+    assert gitbranchstack.OBJECT_CACHE_USAGE.update() == size + len(new.body)
+
+    gitbranchstack.trim_object_cache(repo, limit=0)
+    assert persisted.oid not in repo._objects[persisted.oid[0]]
+    assert unpersisted.oid in repo._objects[unpersisted.oid[0]]
+    assert repo.get_obj(persisted.oid) == persisted
+
+def test_watch(repo, monkeypatch) -> None:
+    # Let the test restore what watch() changes.
+    monkeypatch.setattr(gitbranchstack, "INTERACTIVE", True)
+    monkeypatch.setattr(gitbranchstack.merge, "conflict_prompt", None)
+    repo.git("commit", "--allow-empty", "-m", "[a] a1")
+
+    rebuilds = []
+    def rebuild():
+        rebuilds.append(repo.git("log", "--format=%s", "-1").decode())
+        if len(rebuilds) == 2:
+            raise gitbranchstack.MergeConflict("errors are reported")
+    sleeps = []
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 3:
+            repo.git("commit", "--allow-empty", "-m", "[a] a2")
+        if len(sleeps) == 6:
+            repo.git("commit", "--allow-empty", "-m", "[a] a3")
+        if len(sleeps) == 10:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(gitbranchstack.time, "sleep", sleep)
+
+    gitbranchstack.watch(repo, rebuild)
+    assert rebuilds == ["[a] a1", "[a] a2", "[a] a3"]
+
+def test_main_watch_report(repo, capsys, monkeypatch) -> None:
+    monkeypatch.setattr(gitbranchstack, "watch", lambda repo, rebuild: rebuild())
+    repo.git("commit", "--allow-empty", "-m", "[a] a1")
+
+    gitbranchstack.main(["--watch", "--range", f"{INITIAL_COMMIT}..HEAD"])
+    a = repo.git("rev-parse", "--short=7", "a").decode()
+    assert capsys.readouterr().out.endswith(f"\na\n\t {a} a1\n")
+
+def test_main_graph(repo, capsys) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[wörk:a] w1")
+    repo.git("commit", "--allow-empty", "-m", "[b] b1")
+    repo.git("commit", "--allow-empty", "-m", "[a:+b] a1")
+    repo.git("commit", "--allow-empty", "-m", "[c:a:missing] c1")
+    repo.git("commit", "--allow-empty", "-m", "[d] d1")
+
+    gitbranchstack.main(["graph", "--range", f"{INITIAL_COMMIT}..HEAD", "c"])
+    graph = json.loads(capsys.readouterr().out)
+    commit = lambda rev: repo.git("rev-parse", rev).decode()
+    assert graph == {
+        "base": commit(INITIAL_COMMIT),
+        "tip": commit("HEAD"),
+        "order": ["b", "a", "c"],
+        "topics": {
+            "b": {
+                "commits": [{"commit": commit("HEAD~3"), "subject": "b1"}],
+                "dependencies": [],
+                "transitive_dependencies": [],
+                "missing_dependencies": [],
+            },
+            "a": {
+                "commits": [{"commit": commit("HEAD~2"), "subject": "a1"}],
+                "dependencies": [{"topic": "b", "keep_tag": True}],
+                "transitive_dependencies": ["b"],
+                "missing_dependencies": [],
+            },
+            "c": {
+                "commits": [{"commit": commit("HEAD~"), "subject": "c1"}],
+                "dependencies": [
+                    {"topic": "a", "keep_tag": False},
+                    {"topic": "missing", "keep_tag": False},
+                ],
+                "transitive_dependencies": ["b", "a"],
+                "missing_dependencies": ["missing"],
+            },
+        },
+    }
+
+    gitbranchstack.main(["graph", "--range", f"{INITIAL_COMMIT}..HEAD", "--format=dot", "wörk"])
+    assert capsys.readouterr().out == textwrap.dedent(
+        """\
+        digraph branchstack {
+        \t"b" [label="b (1)"];
+        \t"a" [label="a (1)"];
+        \t"wörk" [label="wörk (1)"];
+        \t"a" -> "b" [style=dashed];
+        \t"wörk" -> "a";
+        }
+        """
+    )
+
+def test_main_pick(repo, capsys) -> None:
+    repo.git("checkout", "-q", "-b", "feature")
+    repo.git("add", write("f", "new\n"))
+    repo.git("commit", "-m", "f1")
+    repo.git("commit", "--allow-empty", "-m", "f2")
+    repo.git("checkout", "-q", "🐬")
+    repo.git("commit", "--allow-empty", "-m", "[x] x1")
+    repo.git("add", write("f", "old\n"))
+    repo.git("commit", "-m", "[feature] old")
+    repo.git("add", write("g", "g\n"))
+    repo.git("commit", "-m", "[y] y1")
+    reflog = repo.git("reflog", "HEAD").decode().splitlines()
+
+    gitbranchstack.main(["pick", "..feature"])
+    assert capsys.readouterr().out.startswith("picked 2, skipped 0 and dropped 1 commits")
+    expected = """\
+*  (HEAD -> 🐬) [y] y1
+*  [feature] f2
+*  [feature] f1
+*  [x] x1
+*  本"""
+    assert expected == graph(repo)
+    with open("f") as f:
+        assert f.read() == "new\n"
+    assert repo.git("status", "--porcelain").decode() == ""
+    assert len(repo.git("reflog", "HEAD").decode().splitlines()) == len(reflog) + 1
+
+    gitbranchstack.main(["pick", "feature..feature"])
+    assert capsys.readouterr().out == "nothing to cherry-pick from feature..feature\n"
+
+def test_main_pick_conflict(repo, monkeypatch, capsys) -> None:
+    repo.git("add", write("f", "1\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("checkout", "-q", "-b", "feature")
+    repo.git("add", write("f", "feature\n"))
+    repo.git("commit", "-m", "f1")
+    repo.git("checkout", "-q", "🐬")
+    repo.git("add", write("f", "x\n"))
+    repo.git("commit", "-m", "[x] x1")
+
+    # Patch IDs are kept even if we abort.
+    monkeypatch.setattr("builtins.input", lambda prompt: "n")
+    with pytest.raises(SystemExit):
+        gitbranchstack.main(["pick", "..feature"])
+    assert gitbranchstack.load_patch_id_cache(repo)
+
+    monkeypatch.setattr(gitbranchstack.utils, "edit_file", lambda repo, path: b"merged\n")
+    monkeypatch.setattr("builtins.input", lambda prompt: "y")
+    gitbranchstack.main(["pick", "..feature"])
+    assert "Conflict applying 'f1'" in capsys.readouterr().out
+    assert repo.git("log", "-1", "--format=%s").decode() == "[feature] f1"
+    with open("f") as f:
+        assert f.read() == "merged\n"
+
+def test_main_pick_multiple_ranges(repo, capsys) -> None:
+    repo.git("checkout", "-q", "-b", "one")
+    repo.git("add", write("f", "f\n"))
+    repo.git("commit", "-m", "f1")
+    repo.git("checkout", "-q", "-b", "two", INITIAL_COMMIT)
+    repo.git("add", write("x", "x\n"))
+    repo.git("commit", "-m", "same patch as x1")
+    repo.git("add", write("h", "h\n"))
+    repo.git("commit", "-m", "h1")
+    repo.git("checkout", "-q", "🐬")
+    repo.git("add", write("x", "x\n"))
+    repo.git("commit", "-m", "[x] x1")
+
+    gitbranchstack.main(["pick", "..one", "..two"])
+    assert capsys.readouterr().out.startswith("picked 2, skipped 1 and dropped 0 commits")
+    expected = """\
+*  (HEAD -> 🐬) [two] h1
+*  [one] f1
+*  [x] x1
+*  本"""
+    assert expected == graph(repo)
+
+    cache = gitbranchstack.load_patch_id_cache(repo)
+    commits = repo.git("rev-list", "HEAD~2", "one", "two", "--not", INITIAL_COMMIT).decode().split()
+    assert set(commits) <= set(cache)
+    assert cache[repo.git("rev-parse", "two~").decode()] == cache[
+        repo.git("rev-parse", "HEAD~2").decode()
+    ]
+
+def test_main_list_branches(repo, capsys) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[a] a1")
+    repo.git("commit", "--allow-empty", "-m", "[b:a] b1")
+    repo.git("commit", "--allow-empty", "-m", "[a] a2")
+    repo.git("commit", "--allow-empty", "-m", "[c] c1")
+    commit = lambda rev: repo.git("rev-parse", rev).decode()
+    list_branches = ["list-branches", "--range", f"{INITIAL_COMMIT}..HEAD"]
+
+    gitbranchstack.main(list_branches)
+    assert capsys.readouterr().out == textwrap.dedent(
+        """\
+        a missing    2 commits
+        b missing    1 commit, depends on a
+        c missing    1 commit
+        """
+    )
+
+    gitbranchstack.create_branches(repo, "🐬", INITIAL_COMMIT)
+    repo.git("branch", "-f", "c", INITIAL_COMMIT)
+    repo.git("commit", "--allow-empty", "-m", "[a] a3")
+    capsys.readouterr()
+    gitbranchstack.main(list_branches + ["--format=json", "a", "b"])
+    assert json.loads(capsys.readouterr().out) == {
+        "topics": [
+            {
+                "topic": "a",
+                "commits": 3,
+                "dependencies": [],
+                "first_commit": commit("HEAD~4"),
+                "last_commit": commit("HEAD"),
+                "status": "stale",
+            },
+            {
+                "topic": "b",
+                "commits": 1,
+                "dependencies": ["a"],
+                "first_commit": commit("HEAD~3"),
+                "last_commit": commit("HEAD~3"),
+                "status": "stale",
+            },
+        ]
+    }
+
+    gitbranchstack.create_branches(repo, "🐬", INITIAL_COMMIT, branches=["a", "b"])
+    capsys.readouterr()
+    gitbranchstack.main(list_branches)
+    assert capsys.readouterr().out == textwrap.dedent(
+        """\
+        a up-to-date 3 commits
+        b up-to-date 1 commit, depends on a
+        c modified   1 commit
+        """
+    )
+
+def test_topological_order() -> None:
+    dep_graph = {
+        "a": {"c": False},
+        "b": {},
+        "c": {"b": False, "x": False},
+        "d": {"a": False, "b": True},
+    }
+    assert gitbranchstack.topological_order(dep_graph) == ["b", "c", "a", "d"]
+    closures = gitbranchstack.dependency_closures(dep_graph)
+    assert closures["d"] == {"d": False, "a": False, "c": False, "b": False, "x": False}
+    assert closures["b"] == {"b": False}
+
+def test_create_branches_dependency_cycle(repo, capsys) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[a:b] a1")
+    repo.git("commit", "--allow-empty", "-m", "[b:a] b1")
+
+    with pytest.raises(SystemExit):
+        gitbranchstack.main(["--range", f"{INITIAL_COMMIT}..HEAD"])
+    assert capsys.readouterr().out == "error: topics depend on each other: a -> b -> a\n"
+    assert not repo.git("branch", "--list", "a", "b")
+
+def test_create_branches_conflict_hint(repo, monkeypatch, capsys) -> None:
+    repo.git("add", write("f", "1\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("add", write("f", "a\n"))
+    repo.git("commit", "-m", "[a] change f")
+    repo.git("add", write("g", "g\n"))
+    repo.git("commit", "-m", "[c] add g")
+    repo.git("add", write("f", "b\n"))
+    repo.git("commit", "-m", "[b] change f again")
+
+    assert gitbranchstack.check_dependencies(repo, "HEAD~3") == {"b": {"a": ["f"]}}
+    assert gitbranchstack.check_dependencies(repo, "HEAD~3", branches=("a",)) == {}
+
+    monkeypatch.setattr("builtins.input", lambda prompt: "n")
+    capsys.readouterr()
+    try:
+        gitbranchstack.create_branches(repo, None, "HEAD~3", "HEAD", branches=("b",))
+        assert False, "Expect error about aborted conflict resolution"
+    except gitbranchstack.MergeConflict:
+        pass
+    a = repo.git("rev-parse", "--short=7", "HEAD~2").decode()
+    assert (
+        "Missing dependency on one of the commits below?\n"
+        f"\t{a} [a] change f\n"
+    ) in capsys.readouterr().out
+
+def test_create_branches_reuse_conflict_resolution(repo, monkeypatch) -> None:
+    repo.git("add", write("f", "1\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("add", write("f", "a\n"))
+    repo.git("commit", "-m", "[a] change f")
+    repo.git("add", write("g", "g\n"))
+    repo.git("commit", "-m", "[c] add g")
+    repo.git("add", write("f", "b\n"))
+    repo.git("commit", "-m", "[b] change f again")
+    repo.git("add", write("h", "h\n"))
+    repo.git("commit", "-m", "[d:b:c] add h")
+
+    edits = []
+    def edit_file(repo, path):
+        edits.append(path)
+        return b"resolved\n"
+    monkeypatch.setattr(gitbranchstack.utils, "edit_file", edit_file)
+    monkeypatch.setattr("builtins.input", lambda prompt: "y")
+    gitbranchstack.create_branches(repo, None, "HEAD~4", "HEAD", branches=("b", "d"))
+    assert len(edits) == 1
+    assert repo.git("show", "b:f").decode() == "resolved"
+    assert repo.git("show", "d:f").decode() == "resolved"
+
+    # Later runs reuse the resolution, even without any other caches.
+    for cache in ("branchstack-cache", "branchstack-rebase-cache"):
+        (repo.gitdir / cache).unlink()
+    repo.git("branch", "-D", "b", "d")
+    monkeypatch.setattr("builtins.input", None)
+    # Only recently used resolutions are kept.
+    resolutions = gitbranchstack.load_resolutions(repo)
+    (resolved,) = resolutions.items()
+    resolutions[("unused", "-", "1" * 40, "2" * 40)] = "3" * 40
+    gitbranchstack.save_resolutions(repo, resolutions)
+    monkeypatch.setattr(gitbranchstack, "RESOLUTION_CACHE_SIZE", 1)
+    gitbranchstack.create_branches(repo, None, "HEAD~4", "HEAD", branches=("b", "d"))
+    assert len(edits) == 1
+    assert repo.git("show", "d:f").decode() == "resolved"
+    assert list(gitbranchstack.load_resolutions(repo).items()) == [resolved]
+
+def test_predict_conflicts(repo) -> None:
+    repo.git("add", write("f", "1\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("add", write("f", "b1\n"))
+    repo.git("commit", "-m", "[b] b1")
+    repo.git("add", write("f", "a1\n"))
+    repo.git("commit", "-m", "[a:b] a1")
+    repo.git("add", write("f", "b2\n"))
+    repo.git("commit", "-m", "[b] b2")
+    Path("d").mkdir()
+    repo.git("add", write("d/x", "x\n"))
+    repo.git("commit", "-m", "[c] add directory d")
+    repo.git("rm", "-r", "d")
+    repo.git("add", write("d", "d\n"))
+    repo.git("commit", "-m", "[e] replace directory d with a file")
+    repo.git("add", write("g", "g\n"))
+    repo.git("commit", "-m", "[g] add g")
+
+    # Topic b's second commit is applied without a1 in between.
+    assert gitbranchstack.predict_conflicts(repo, "HEAD~7") == {
+        "b": ["f"],
+        "a": ["f"],
+        "c": [],
+        "e": ["d", "d/x"],
+        "g": [],
+    }
+
+def test_path_index_empty_message(repo) -> None:
+    repo.git("add", write("f", "1\n"))
+    repo.git("commit", "-m", "base")
+    repo.git("add", write("f", "2\n"))
+    repo.git("commit", "--allow-empty-message", "-m", "")
+    repo.git("add", write("f", "a\n"))
+    repo.git("commit", "-m", "[a] a1")
+
+    assert gitbranchstack.check_dependencies(repo, "HEAD~2") == {}
+    assert gitbranchstack.predict_conflicts(repo, "HEAD~2") == {"a": ["f"]}
+    path_index = gitbranchstack.PathIndex(repo, "[", "]", "HEAD~2..HEAD")
+    empty = repo.git("rev-parse", "HEAD~").decode()
+    assert path_index.commits_before(repo.git("rev-parse", "HEAD").decode(), "f") == [
+        (empty, None, "")
+    ]
+
 def test_dwim(repo) -> None:
     origin = "origin.git"
     assert Popen(("git", "init", "--bare", origin)).wait() == 0
@@ -254,17 +971,130 @@ def test_parse_log_include_others(repo) -> None:
         (None, "a b c"),
     )
 
+def test_parse_log_small_chunks(repo, monkeypatch) -> None:
+    repo.git("commit", "--allow-empty", "-m", "[a] a1\n\nlong\nbody")
+    repo.git("commit", "--allow-empty", "-m", "[b:a] multi\nline\nsubject")
+    repo.git("commit", "--allow-empty", "-m", "no topic")
+    monkeypatch.setattr(gitbranchstack, "LOG_CHUNK_SIZE", 7)
+
+    commit_entries, dependency_graph = gitbranchstack.parse_log(
+        repo, "[", "]", f"{INITIAL_COMMIT}..HEAD", "--reverse"
+    )
+    assert tuple((topic, message) for commit_id, topic, message in commit_entries) == (
+        ("a", "a1"),
+        ("b", "multi line subject"),
+    )
+    assert dependency_graph == {"a": {}, "b": {"a": False}}
+
+    log = gitbranchstack.iter_log(repo, "[", "]", f"{INITIAL_COMMIT}..HEAD")
+    assert next(log)[1:3] == (None, "no topic")
+    log.close()
+
+def test_group_by_topic() -> None:
+    commit_entries = [
+        ("1", "a", "a1"),
+        ("2", "b", "b1"),
+        ("3", "a", "a2"),
+        ("4", "c", "c1"),
+        ("5", "b", "b2"),
+    ]
+    commits_by_topic = gitbranchstack.group_by_topic(commit_entries)
+    assert list(commits_by_topic) == ["a", "b", "c"]
+    assert commits_by_topic["b"] == [("2", "b", "b1"), ("5", "b", "b2")]
+    deps = {"c": False, "a": True}
+    assert [
+        (commit, keep_tag)
+        for commit, t, subject, keep_tag in gitbranchstack.topic_commits(
+            commits_by_topic, deps, None, "c"
+        )
+    ] == [("1", True), ("3", True), ("4", False)]
+
+def test_merge_lines() -> None:
+    base = b"a\nb\nc\nd\ne\n"
+    assert (
+        gitbranchstack.merge_lines(b"A\nb\nc\nd\ne\n", base, b"a\nb\nc\nd\nE\n")
+        == b"A\nb\nc\nd\nE\n"
+    )
+    assert (
+        gitbranchstack.merge_lines(b"a\nb\nc\nd\ne\nf", base, b"a\nb\nd\ne\n")
+        == b"a\nb\nd\ne\nf"
+    )
+    # Overlapping, adjacent and identical changes are left to git-merge-file.
+    assert gitbranchstack.merge_lines(b"a\nB\nc\nd\nE\n", base, b"a\nB\nc\nd\ne\n") is None
+    assert gitbranchstack.merge_lines(b"a\nB\nc\nd\ne\n", base, b"a\nX\nc\nd\ne\n") is None
+    assert gitbranchstack.merge_lines(b"a\nB\nc\nd\ne\n", base, b"a\nb\nC\nd\ne\n") is None
+    assert gitbranchstack.merge_lines(b"x\n", b"", b"y\n") is None
+    assert gitbranchstack.merge_lines(b"\0A", b"\0a", b"\0a") is None
+    # Changes are only separated by repeated lines, which could be aligned
+    # in different ways.
+    assert (
+        gitbranchstack.merge_lines(
+            b"Y\nc\na\na\nc\nc\n", b"c\na\na\nc\nc\nc\n", b"c\na\na\nc\nc\n"
+        )
+        is None
+    )
+
+def test_merge_lines_matches_git_merge_file(repo) -> None:
+    rng = random.Random(0)
+    pool = [b"a\n", b"}\n", b"\n"]
+
+    def edit(lines):
+        lines = list(lines)
+        for _ in range(rng.randint(1, 2)):
+            i = rng.randint(0, len(lines))
+            new = [rng.choice(pool + [b"new\n"]) for _ in range(rng.randint(1, 2))]
+            lines[i : i + rng.randint(0, 2)] = new
+        return b"".join(lines)
+
+    tmpdir = repo.get_tempdir()
+    labels = ("current", "base", "other")
+    for _ in range(300):
+        base = [rng.choice(pool + [b"%d\n" % i]) for i in range(rng.randint(0, 12))]
+        current, other = edit(base), edit(base)
+        base = b"".join(base)
+        merged = gitbranchstack.merge_lines(current, base, other)
+        if merged is None:
+            continue
+        assert merge.merge_files(repo, labels, current, base, other, tmpdir) == (
+            True,
+            merged,
+        ), (current, base, other)
+
 def test_transitive_dependencies() -> None:
     dep_graph = {
-        "a": {"c": False},
-        "b": {"a": False},
-        "c": {"b": False},
+        "a": {"b": False, "c": True},
+        "b": {"c": False},
+        "c": {},
     }
+    # The first path to reach a dependency decides if its tag is kept.
     assert gitbranchstack.transitive_dependencies(dep_graph, ("a", False)) == {
         "a": False,
         "b": False,
         "c": False,
     }
+    assert gitbranchstack.transitive_dependencies(dep_graph, ("c", True)) == {
+        "c": True,
+    }
+
+def test_transitive_dependencies_cycle() -> None:
+    dep_graph = {
+        "a": {"c": False},
+        "b": {"a": False},
+        "c": {"b": False},
+    }
+    with pytest.raises(gitbranchstack.DependencyCycleError) as err:
+        gitbranchstack.transitive_dependencies(dep_graph, ("a", False))
+    assert err.value.args == (["a", "c", "b", "a"],)
+    # Topics may list themselves as dependency.
+    assert gitbranchstack.dependency_closures({"a": {"a": False}}) == {
+        "a": {"a": False}
+    }
+
+def test_dependency_closures_long_chain() -> None:
+    n = 2000  # deeper than the default recursion limit
+    dep_graph = {f"t{i}": {f"t{i - 1}": False} if i else {} for i in range(n)}
+    closures = gitbranchstack.dependency_closures(dep_graph)
+    assert len(closures[f"t{n - 1}"]) == n
 
 # Taken from git-revise
 @pytest.fixture(autouse=True)